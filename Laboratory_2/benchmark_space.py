@@ -0,0 +1,243 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import parallel_processing_space as space
+
+# Радиусы синтетических объектов подобраны вдали от границы площади 300,
+# чтобы ожидаемый тип объекта однозначно следовал из classification
+STAR_RADII = (3, 8)
+BRIGHT_STAR_RADII = (13, 20)
+
+# Генерирует синтетическое звездное поле с известными объектами.
+# Объекты не пересекаются, поэтому каждый должен быть найден ровно один раз
+def generateStarField(width, height, objectsCount, brightShare=0.2, seed=0):
+    random = np.random.default_rng(seed)
+    photo = np.zeros((height, width, 3), dtype=np.uint8)
+    photo += random.integers(0, 40, size=photo.shape, dtype=np.uint8)  # Фоновый шум ниже порога
+
+    cellSize = 2 * BRIGHT_STAR_RADII[1] + 8
+    cellsX, cellsY = width // cellSize, height // cellSize
+    cells = random.permutation(cellsX * cellsY)[:objectsCount]
+
+    groundTruth = []
+    for cell in cells:
+        isBright = random.random() < brightShare
+        radius = int(random.integers(*BRIGHT_STAR_RADII) if isBright else random.integers(*STAR_RADII))
+        slack = cellSize // 2 - radius - 2
+        centerX = int((cell % cellsX) * cellSize + cellSize // 2 + random.integers(-slack, slack + 1))
+        centerY = int((cell // cellsX) * cellSize + cellSize // 2 + random.integers(-slack, slack + 1))
+        value = int(random.integers(230, 256))  # Достаточно ярко, чтобы после размытия остаться выше порога
+
+        cv2.circle(photo, (centerX, centerY), radius, (value, value, value), -1)
+        groundTruth.append({
+            "coordinates": (centerX, centerY),
+            "radius": radius,
+            "type": "A bright star" if isBright else "Star"
+        })
+
+    return photo, groundTruth
+
+# Сопоставляет найденные объекты с известными по расстоянию между центрами
+def checkAccuracy(objectsData, groundTruth):
+    truthCenters = np.array([truth["coordinates"] for truth in groundTruth], dtype=np.float64).reshape(-1, 2)
+    truthRadii = np.array([truth["radius"] for truth in groundTruth], dtype=np.float64)
+    matched = np.zeros(len(groundTruth), dtype=bool)
+
+    falseDetections = 0
+    correctTypes = 0
+    for objectData in objectsData:
+        distances = np.hypot(*(truthCenters - np.array(objectData["coordinates"])).T)
+        candidates = np.flatnonzero((distances <= truthRadii + 2) & ~matched)
+        if len(candidates) == 0:
+            falseDetections += 1  # Лишний объект или повторно найденный объект на стыке частей
+            continue
+        truthIndex = candidates[np.argmin(distances[candidates])]
+        matched[truthIndex] = True
+        correctTypes += objectData["type"] == groundTruth[truthIndex]["type"]
+
+    matchedCount = int(matched.sum())
+    return {
+        "recall": matchedCount / len(groundTruth) if groundTruth else 1.0,
+        "precision": matchedCount / len(objectsData) if objectsData else 1.0,
+        "falseDetections": falseDetections,
+        "classificationAccuracy": correctTypes / matchedCount if matchedCount else 1.0
+    }
+
+# Как часто опрашивается память процессов пула, секунды
+MEMORY_SAMPLE_INTERVAL = 0.05
+
+# Резидентная память процесса (МБ) по /proc (Linux); 0, если процесс уже завершился
+def residentMemoryMB(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as statmFile:
+            return int(statmFile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (FileNotFoundError, ProcessLookupError):
+        return 0.0
+
+def childProcessIds():
+    parentId = os.getpid()
+    childIds = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as statFile:
+                fields = statFile.read().rpartition(")")[2].split()  # Имя процесса в скобках может содержать пробелы
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        if int(fields[1]) == parentId:
+            childIds.append(int(entry))
+    return childIds
+
+# Пиковая память этого процесса и суммарная память дочерних процессов (пула), пока не установлен stopEvent
+def sampleMemory(stopEvent, peak):
+    while not stopEvent.is_set():
+        peak["self"] = max(peak["self"], residentMemoryMB(os.getpid()))
+        peak["children"] = max(peak["children"], sum(residentMemoryMB(pid) for pid in childProcessIds()))
+        stopEvent.wait(MEMORY_SAMPLE_INTERVAL)
+
+# Один запуск анализа с заданными размером части и числом процессов; выполняется в новом процессе (runIsolated).
+# Память опрашивается во время запуска: ru_maxrss — максимум за все время процесса (на Linux он сохраняется
+# и после exec), а для дочерних процессов — максимум одного процесса, а не суммарная память пула
+def runConfiguration(inputDir, workDir, groundTruth, partSize, workersCount, partHalo, pipelined):
+    defaultPartSize = space.PART_SIZE
+    space.PART_SIZE = partSize
+    memoryPeak = {"self": 0.0, "children": 0.0}
+    stopSampling = threading.Event()
+    sampler = threading.Thread(target=sampleMemory, args=(stopSampling, memoryPeak), daemon=True)
+    if os.path.isdir("/proc"):
+        sampler.start()
+
+    # Время этапов собирается инструментированием в самом запуске, включая процессы пула
+    space.enableInstrumentation()
+    try:
+        startTime = time.perf_counter()
+        objectsData = space.analyzeAllphotos(inputDir, os.path.join(workDir, "parts"), workersCount, pipelined,
+                                             partHalo=partHalo)
+        elapsed = time.perf_counter() - startTime
+        with space.timedStage("save"):
+            space.save(objectsData, os.path.join(workDir, "statistic.xlsx"))
+        stageTimes = {stageName: stage["total"]
+                      for stageName, stage in space.instrumentationSummary()["stages"].items()}
+    finally:
+        space.disableInstrumentation()
+        space.PART_SIZE = defaultPartSize
+        stopSampling.set()
+        if sampler.is_alive():
+            sampler.join()
+
+    accuracy = [checkAccuracy([objectData for objectData in objectsData if objectData["photo"] == photoName], truth)
+                for photoName, truth in groundTruth.items()]
+    return {
+        "framesPerSecond": len(groundTruth) / elapsed,
+        "objectsPerSecond": len(objectsData) / elapsed,
+        "stageTimes": stageTimes,
+        "peakMemoryMB": memoryPeak if sampler.ident is not None else None,  # Без /proc (Windows, macOS) память не измеряется
+        "recall": min(frameAccuracy["recall"] for frameAccuracy in accuracy),
+        "precision": min(frameAccuracy["precision"] for frameAccuracy in accuracy),
+        "classificationAccuracy": min(frameAccuracy["classificationAccuracy"] for frameAccuracy in accuracy)
+    }
+
+def sendConfigurationResult(connection, arguments):
+    connection.send(runConfiguration(*arguments))
+    connection.close()
+
+# Запуск runConfiguration в новом процессе
+def runIsolated(*arguments):
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=sendConfigurationResult, args=(sender, arguments))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    finally:
+        process.join()
+
+def runBenchmark(resolutions, densities, workersCounts, partSizes, framesCount=2, partHalo=0, pipelined=False, seed=0):
+    benchmarkResults = []
+
+    with tempfile.TemporaryDirectory() as workDir:
+        for width, height in resolutions:
+            for density in densities:
+                # density — число объектов на мегапиксель
+                objectsCount = int(density * width * height / 1e6)
+                inputDir = os.path.join(workDir, f"input_{width}x{height}_{density}")
+                os.makedirs(inputDir)
+
+                groundTruth = {}
+                for frameIndex in range(framesCount):
+                    photo, truth = generateStarField(width, height, objectsCount, seed=seed + frameIndex)
+                    cv2.imwrite(os.path.join(inputDir, f"{frameIndex}.png"), photo)
+                    groundTruth[f"{frameIndex}.png"] = truth
+                objectsCount = sum(len(truth) for truth in groundTruth.values())
+
+                for partSize in partSizes:
+                    for workersCount in workersCounts:
+                        benchmarkResults.append({
+                            "resolution": f"{width}x{height}",
+                            "density": density,
+                            "objects": objectsCount,
+                            "partSize": partSize,
+                            "workers": workersCount,
+                            **runIsolated(inputDir, workDir, groundTruth, partSize, workersCount, partHalo, pipelined)
+                        })
+                        printResult(benchmarkResults[-1])
+
+    return benchmarkResults
+
+def printResult(benchmarkResult):
+    stages = ", ".join(f"{stage} {seconds * 1000:.0f} мс" for stage, seconds in benchmarkResult["stageTimes"].items())
+    memory = benchmarkResult["peakMemoryMB"]
+    memoryText = f"{memory['self']:.0f}/{memory['children']:.0f} МБ (процесс/пул)" if memory else "н/д"
+    print(f"{benchmarkResult['resolution']:>11} плотность {benchmarkResult['density']:>5} часть {benchmarkResult['partSize']:>5} "
+          f"процессов {benchmarkResult['workers']:>2}: {benchmarkResult['framesPerSecond']:.2f} кадр/с, "
+          f"{benchmarkResult['objectsPerSecond']:.0f} объект/с, память {memoryText}, "
+          f"полнота {benchmarkResult['recall']:.3f}, точность {benchmarkResult['precision']:.3f}, "
+          f"классификация {benchmarkResult['classificationAccuracy']:.3f}")
+    print(f"{'':>11} этапы (сумма по процессам): {stages}")
+
+def parseSizes(text):
+    return [tuple(int(value) for value in size.split("x")) for size in text.split(",")]
+
+def parseNumbers(text):
+    return [int(value) for value in text.split(",")]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры производительности и точности анализа космических снимков")
+    parser.add_argument("--resolutions", type=parseSizes, default=parseSizes("2000x2000,4000x4000"))
+    parser.add_argument("--densities", type=parseNumbers, default=parseNumbers("50,400"), help="объектов на мегапиксель")
+    parser.add_argument("--workers", type=parseNumbers, default=parseNumbers(f"1,{os.cpu_count()}"))
+    parser.add_argument("--part-sizes", dest="partSizes", type=parseNumbers, default=parseNumbers("500,1000"))
+    parser.add_argument("--frames", type=int, default=2)
+    parser.add_argument("--halo", type=int, default=64, help="перекрытие частей; при 0 объекты на стыках делятся")
+    parser.add_argument("--pipelined", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-recall", dest="minRecall", type=float, help="завершиться с ошибкой, если полнота ниже")
+    parser.add_argument("--json", dest="jsonPath", help="сохранить результаты в JSON")
+    arguments = parser.parse_args(argv)
+
+    benchmarkResults = runBenchmark(arguments.resolutions, arguments.densities, arguments.workers, arguments.partSizes,
+                                    arguments.frames, arguments.halo, arguments.pipelined, arguments.seed)
+
+    if arguments.jsonPath:
+        with open(arguments.jsonPath, "w", encoding="utf-8") as jsonFile:
+            json.dump(benchmarkResults, jsonFile, ensure_ascii=False, indent=4)
+
+    # Классификация синтетических объектов однозначна, поэтому любая ошибка типа — регрессия
+    failed = any(result["classificationAccuracy"] < 1.0 for result in benchmarkResults)
+    if arguments.minRecall is not None:
+        failed = failed or any(result["recall"] < arguments.minRecall for result in benchmarkResults)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,46 +1,319 @@
 import cv2
 import multiprocessing as multiprocessing
+from multiprocessing import resource_tracker, shared_memory
 import numpy as np
 import os
-from openpyxl import Workbook
-import tkinter as tk
-from tkinter import filedialog
-from tkinter import messagebox
-
+import sys
+import argparse
+import csv
+import json
+import hashlib
+import inspect
+import pickle
+import threading
+import time
+import cProfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Параметры анализа; входят в ключ кэша результатов
+PHOTO_THRESHOLD = 180
+BLUR_KERNEL = (5, 5)
+PART_SIZE = 1000
+
+# Несжатые форматы, которые читаются частями через numpy.memmap, а не декодируются целиком
+MAPPED_PHOTO_EXTENSIONS = ('.npy', '.fits', '.fit')
+FITS_BLOCK_SIZE = 2880
+
+PHOTO_CACHE_VERSION = 1
+PHOTO_CACHE_MAX_BYTES = 1 << 30
+
+# Инструментирование. stageTimings: время этапов {этап: [секунды]} — в основном процессе за весь запуск,
+# в процессе пула за одну часть; partTimings: (секунды, изображение, часть) в основном процессе.
+# None означает, что сбор отключен. profileDir: каталог для профилей cProfile каждой части
+stageTimings = None
+partTimings = None
+partStartTime = None
+profileDir = None
+
+STAGE_HISTOGRAM_EDGES = (0.0, 0.0001, 0.001, 0.01, 0.1, 1.0, float("inf"))
+STAGE_HISTOGRAM_LABELS = ("<0.1 мс", "0.1-1 мс", "1-10 мс", "10-100 мс", "0.1-1 с", ">1 с")
+
+@contextmanager
+def timedStage(stageName):
+    if stageTimings is None:
+        yield
+        return
+    startTime = time.perf_counter()
+    try:
+        yield
+    finally:
+        stageTimings.setdefault(stageName, []).append(time.perf_counter() - startTime)
+
+# Включает сбор времени этапов для следующих запусков (пул процессов должен создаваться после вызова)
+def enableInstrumentation(profileDirectory=None):
+    global stageTimings, partTimings, profileDir
+    stageTimings = {}
+    partTimings = []
+    profileDir = profileDirectory
+    if profileDir:
+        os.makedirs(profileDir, exist_ok=True)
+
+def disableInstrumentation():
+    global stageTimings, partTimings, profileDir
+    stageTimings = partTimings = profileDir = None
+
+# Инициализация процесса пула: настройки инструментирования передаются явно, так как при spawn
+# глобальные переменные основного процесса не наследуются
+def initializeWorker(instrumented, profileDirectory):
+    global stageTimings, partTimings, profileDir
+    stageTimings = {} if instrumented else None
+    partTimings = None
+    profileDir = profileDirectory
+
+# В процессе пула: начало замеров новой части
+def startPartMetrics():
+    global stageTimings, partStartTime
+    if stageTimings is not None:
+        stageTimings = {}
+        partStartTime = time.perf_counter()
+
+# В процессе пула: анализ части с замерами и (если задан profileDir) профилем cProfile.
+# Возвращает данные объектов, контуры и метрики части (None, если сбор отключен)
+def analyzeMeasuredPart(photoPart, partIndex, photoName, offsetX, offsetY, coreBounds):
+    if stageTimings is None:
+        objectsData, contourCenters = analyzePhotoPart((photoPart, partIndex, photoName, offsetX, offsetY, coreBounds))
+        return objectsData, contourCenters, None
+
+    profiler = cProfile.Profile() if profileDir else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        objectsData, contourCenters = analyzePhotoPart((photoPart, partIndex, photoName, offsetX, offsetY, coreBounds))
+    finally:
+        if profiler is not None:
+            profiler.disable()
+
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(profileDir, f"{os.path.splitext(photoName)[0]}-{partIndex + 1}.prof"))
+
+    partMetrics = {
+        "photo": photoName,
+        "partIndex": partIndex + 1,
+        "seconds": time.perf_counter() - partStartTime,
+        "stages": stageTimings
+    }
+    return objectsData, contourCenters, partMetrics
+
+# В основном процессе: добавляет метрики части, полученные от процесса пула
+def recordPartMetrics(partMetrics):
+    if partMetrics is None or stageTimings is None:
+        return
+    for stageName, durations in partMetrics["stages"].items():
+        stageTimings.setdefault(stageName, []).extend(durations)
+    partTimings.append((partMetrics["seconds"], partMetrics["photo"], partMetrics["partIndex"]))
+
+# Итог запуска: статистика и гистограмма по каждому этапу и самые медленные части
+def instrumentationSummary(slowestCount=10):
+    if stageTimings is None:
+        return None
+
+    stages = {}
+    for stageName, durations in stageTimings.items():
+        durations = np.array(durations)
+        histogram, _ = np.histogram(durations, bins=STAGE_HISTOGRAM_EDGES)
+        stages[stageName] = {
+            "count": len(durations),
+            "total": float(durations.sum()),
+            "mean": float(durations.mean()),
+            "p50": float(np.percentile(durations, 50)),
+            "p95": float(np.percentile(durations, 95)),
+            "max": float(durations.max()),
+            "histogram": dict(zip(STAGE_HISTOGRAM_LABELS, histogram.tolist()))
+        }
+
+    slowestParts = [{"photo": photoName, "partIndex": partIndex, "seconds": seconds}
+                    for seconds, photoName, partIndex in sorted(partTimings, reverse=True)[:slowestCount]]
+    return {"stages": stages, "slowestParts": slowestParts}
+
+def formatInstrumentationSummary(summary):
+    lines = ["Этап                  число    всего, с  среднее, мс     p95, мс    макс, мс  гистограмма"]
+    for stageName, stage in sorted(summary["stages"].items(), key=lambda item: -item[1]["total"]):
+        histogram = " ".join(f"{label}:{count}" for label, count in stage["histogram"].items() if count)
+        lines.append(f"{stageName:<20} {stage['count']:>6} {stage['total']:>11.3f} {stage['mean'] * 1000:>12.2f} "
+                     f"{stage['p95'] * 1000:>11.2f} {stage['max'] * 1000:>11.2f}  {histogram}")
+    lines.append("Самые медленные части:")
+    for part in summary["slowestParts"]:
+        lines.append(f"  {part['photo']} часть {part['partIndex']}: {part['seconds'] * 1000:.1f} мс")
+    return "\n".join(lines)
+
+# Необязательный шестой аргумент coreBounds = (x0, y0, x1, y1) задает основную часть внутри
+# переданной части с перекрытием: учитываются только объекты, центр которых лежит в основной части
 def analyzePhotoPart(arguments):
-    photoPart, partIndex, photoName, offsetX, offsetY = arguments
+    photoPart, partIndex, photoName, offsetX, offsetY = arguments[:5]
+    coreX0, coreY0, coreX1, coreY1 = arguments[5] if len(arguments) > 5 else (0, 0, photoPart.shape[1], photoPart.shape[0])
     
-    grayphoto = cv2.cvtColor(photoPart, cv2.COLOR_BGR2GRAY)
-    blurredphoto = cv2.GaussianBlur(grayphoto, (5, 5), 0)
-    _, binaryphoto = cv2.threshold(blurredphoto, 180, 255, cv2.THRESH_BINARY)
-    contours, _ = cv2.findContours(binaryphoto, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    with timedStage("grayscale"):
+        grayphoto = cv2.cvtColor(photoPart, cv2.COLOR_BGR2GRAY)
+    with timedStage("blur"):
+        blurredphoto = cv2.GaussianBlur(grayphoto, BLUR_KERNEL, 0)
+    with timedStage("threshold"):
+        _, binaryphoto = cv2.threshold(blurredphoto, PHOTO_THRESHOLD, 255, cv2.THRESH_BINARY)
+    with timedStage("findContours"):
+        contours, _ = cv2.findContours(binaryphoto, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     
     objectsData = []
     contourCenters = []
 
-    for contour in contours:
-        contourArea = cv2.contourArea(contour)
-        x, y, contourWidth, contourHeight = cv2.boundingRect(contour)
-        centerX = x + contourWidth // 2 + offsetX
-        centerY = y + contourHeight // 2 + offsetY
-        
-        brightness = np.sum(grayphoto[y:y + contourHeight, x:x + contourWidth])
-        objectType = classification(contourArea, brightness)
-        
-        if objectType != "-":
-            objectsData.append({
-                "photo": photoName,
-                "partIndex": partIndex + 1,
-                "coordinates": (centerX, centerY),
-                "brightness": brightness,
-                "area": int(contourArea),
-                "type": objectType
-            })
-            
-            contourCenters.append((centerX - offsetX, centerY - offsetY, max(contourWidth, contourHeight) // 2, objectType))
+    if not contours:
+        return objectsData, contourCenters
+
+    with timedStage("measure"):
+        contourAreas, boundingRects = measureContours(contours)
+        x, y, contourWidth, contourHeight = boundingRects.T
+        centerX = x + contourWidth // 2
+        centerY = y + contourHeight // 2
+
+        # Яркость как сумма по ограничивающему прямоугольнику, через интегральное изображение для всех объектов сразу
+        integralphoto = cv2.integral(grayphoto, sdepth=cv2.CV_64F)
+        brightness = (integralphoto[y + contourHeight, x + contourWidth] - integralphoto[y, x + contourWidth]
+                      - integralphoto[y + contourHeight, x] + integralphoto[y, x]).astype(np.uint64)
+    with timedStage("classification"):
+        objectTypes = classificationBatch(contourAreas, brightness)
+
+    # Объект на стыке частей учитывается только той частью, в основную область которой попал его центр
+    selected = ((coreX0 <= centerX) & (centerX < coreX1) & (coreY0 <= centerY) & (centerY < coreY1)
+                & (objectTypes != "-"))
+    radius = (np.maximum(contourWidth, contourHeight) // 2)[selected].tolist()
+    brightness = brightness[selected]
+    contourAreas = contourAreas[selected].astype(np.int64).tolist()
+    objectTypes = objectTypes[selected].tolist()
+    centerX = centerX[selected].tolist()
+    centerY = centerY[selected].tolist()
+
+    for index, objectType in enumerate(objectTypes):
+        objectsData.append({
+            "photo": photoName,
+            "partIndex": partIndex + 1,
+            "coordinates": (centerX[index] + offsetX, centerY[index] + offsetY),
+            "brightness": brightness[index],
+            "area": contourAreas[index],
+            "type": objectType
+        })
+
+        contourCenters.append((centerX[index] - coreX0, centerY[index] - coreY0, radius[index], objectType))
 
     return objectsData, contourCenters
 
+# Площади (как cv2.contourArea) и ограничивающие прямоугольники (как cv2.boundingRect) всех контуров за один проход:
+# точки контуров склеиваются в один массив, а суммы и экстремумы считаются по отрезкам через reduceat
+def measureContours(contours):
+    contourLengths = np.array([len(contour) for contour in contours])
+    contourEnds = np.cumsum(contourLengths)
+    contourStarts = contourEnds - contourLengths
+
+    points = np.concatenate(contours).reshape(-1, 2).astype(np.int64)
+    pointsX, pointsY = points[:, 0], points[:, 1]
+
+    # Формула площади Гаусса: следующая точка для последней точки контура — его первая точка
+    nextPoints = np.arange(1, len(points) + 1)
+    nextPoints[contourEnds - 1] = contourStarts
+    crossProducts = pointsX * pointsY[nextPoints] - pointsX[nextPoints] * pointsY
+    contourAreas = np.abs(np.add.reduceat(crossProducts, contourStarts)) / 2.0
+
+    minX = np.minimum.reduceat(pointsX, contourStarts)
+    minY = np.minimum.reduceat(pointsY, contourStarts)
+    maxX = np.maximum.reduceat(pointsX, contourStarts)
+    maxY = np.maximum.reduceat(pointsY, contourStarts)
+    boundingRects = np.stack([minX, minY, maxX - minX + 1, maxY - minY + 1], axis=1)
+
+    return contourAreas, boundingRects
+
+# Анализ части изображения, лежащего в общей памяти: процесс получает только имя блока и координаты части.
+# При partHalo > 0 часть расширяется на partHalo пикселей с каждой стороны, чтобы объекты на стыках
+# частей измерялись целиком (для объектов меньше перекрытия результат совпадает с анализом всего изображения)
+def analyzeSharedPhotoPart(arguments):
+    sharedName, photoShape, partShape, partIndex, photoName, offsetX, offsetY, partHalo = arguments
+    haloX0, haloY0, haloX1, haloY1, coreBounds = partHaloBounds(photoShape, partShape, offsetX, offsetY, partHalo)
+    startPartMetrics()
+
+    sharedPhoto = shared_memory.SharedMemory(name=sharedName)
+    try:
+        photo = np.ndarray(photoShape, dtype=np.uint8, buffer=sharedPhoto.buf)
+        photoPart = photo[haloY0:haloY1, haloX0:haloX1]
+        result = analyzeMeasuredPart(photoPart, partIndex, photoName, haloX0, haloY0, coreBounds)
+    finally:
+        # Представления должны быть освобождены до закрытия блока общей памяти
+        photo = photoPart = None
+        sharedPhoto.close()
+
+    return result
+
+# Анализ части несжатого изображения: процесс сам читает из файла только свою часть с перекрытием
+def analyzeMappedPhotoPart(arguments):
+    photoPath, photoShape, partShape, partIndex, photoName, offsetX, offsetY, partHalo = arguments
+    haloX0, haloY0, haloX1, haloY1, coreBounds = partHaloBounds(photoShape, partShape, offsetX, offsetY, partHalo)
+    startPartMetrics()
+
+    with timedStage("readPart"):
+        photo = openMappedphoto(photoPath)
+        photoPart = toBGRphoto(photo[haloY0:haloY1, haloX0:haloX1])
+    return analyzeMeasuredPart(photoPart, partIndex, photoName, haloX0, haloY0, coreBounds)
+
+# Границы части, расширенной на partHalo пикселей, и положение основной части внутри нее
+def partHaloBounds(photoShape, partShape, offsetX, offsetY, partHalo):
+    haloX0 = max(offsetX - partHalo, 0)
+    haloY0 = max(offsetY - partHalo, 0)
+    haloX1 = min(offsetX + partShape[1] + partHalo, photoShape[1])
+    haloY1 = min(offsetY + partShape[0] + partHalo, photoShape[0])
+    coreBounds = (offsetX - haloX0, offsetY - haloY0,
+                  offsetX - haloX0 + partShape[1], offsetY - haloY0 + partShape[0])
+    return haloX0, haloY0, haloX1, haloY1, coreBounds
+
+# Открывает несжатое изображение через numpy.memmap, не читая данные: .npy (uint8, BGR или оттенки серого)
+# или FITS с BITPIX = 8 (двумерный или с тремя плоскостями R, G, B). Возвращает массив высота x ширина (x 3)
+def openMappedphoto(photoPath):
+    if photoPath.lower().endswith('.npy'):
+        photo = np.load(photoPath, mmap_mode='r')
+        if photo.dtype != np.uint8 or not (photo.ndim == 2 or (photo.ndim == 3 and photo.shape[2] == 3)):
+            raise ValueError(f"Поддерживаются только .npy с dtype uint8 и формой (высота, ширина) "
+                             f"или (высота, ширина, 3): {photoPath}")
+        return photo
+
+    fitsHeader, dataOffset = readFitsHeader(photoPath)
+    if fitsHeader.get("BITPIX") != "8" or fitsHeader.get("NAXIS") not in ("2", "3"):
+        raise ValueError(f"Поддерживаются только FITS с BITPIX = 8 и NAXIS = 2 или 3: {photoPath}")
+    if fitsHeader["NAXIS"] == "3" and fitsHeader.get("NAXIS3") != "3":
+        raise ValueError(f"Поддерживаются только FITS с тремя цветовыми плоскостями (NAXIS3 = 3): {photoPath}")
+
+    photoShape = [int(fitsHeader[f"NAXIS{axis}"]) for axis in range(int(fitsHeader["NAXIS"]), 0, -1)]
+    photo = np.memmap(photoPath, dtype=np.uint8, mode='r', offset=dataOffset, shape=tuple(photoShape))
+    if photo.ndim == 3:
+        photo = photo.transpose(1, 2, 0)[:, :, ::-1]  # Плоскости R, G, B -> высота x ширина x BGR
+    return photo
+
+# Читает заголовок FITS (записи по 80 символов в блоках по 2880 байт) и возвращает его и смещение данных
+def readFitsHeader(photoPath):
+    fitsHeader = {}
+    with open(photoPath, "rb") as photoFile:
+        while True:
+            headerBlock = photoFile.read(FITS_BLOCK_SIZE)
+            if len(headerBlock) < FITS_BLOCK_SIZE:
+                raise ValueError(f"Неполный заголовок FITS: {photoPath}")
+            for cardStart in range(0, FITS_BLOCK_SIZE, 80):
+                card = headerBlock[cardStart:cardStart + 80].decode("ascii", errors="replace")
+                keyword = card[:8].strip()
+                if keyword == "END":
+                    return fitsHeader, photoFile.tell()
+                if card[8:10] == "= ":
+                    fitsHeader[keyword] = card[10:].split("/")[0].strip()
+
+# Копия части изображения в формате BGR, пригодном для анализа и рисования
+def toBGRphoto(photoPart):
+    if photoPart.ndim == 2:
+        return cv2.cvtColor(np.ascontiguousarray(photoPart), cv2.COLOR_GRAY2BGR)
+    return np.array(photoPart, dtype=np.uint8, order="C")
+
 def classification(area, brightness):
     if area < 300 and brightness > 200:
         return "Star"
@@ -51,78 +324,324 @@ def classification(area, brightness):
     else:
         return "Star"
 
-def processAllphotos(inputDirectory, outputXLSXPath, outputphotoDir):
-    allResults = []
-
-    for photoName in os.listdir(inputDirectory):
-        photoPath = os.path.join(inputDirectory, photoName)
-        if photoPath.lower().endswith(('.png', '.jpg')):
-            objectsData = processphoto(photoPath, outputphotoDir)
-            allResults.extend(objectsData)
-
-    save(allResults, outputXLSXPath)
+# Та же классификация, что и classification, для массивов площадей и яркостей
+def classificationBatch(areas, brightness):
+    brightness = brightness.astype(np.float64)
+    return np.select(
+        [(areas < 300) & (brightness > 200),
+         (areas > 300) & (brightness > 1000),
+         (areas > 300) & (brightness < 200)],
+        ["Star", "A bright star", "Planet"],
+        default="Star"
+    ).astype(object)
+
+def processAllphotos(inputDirectory, outputXLSXPath, outputphotoDir, processesCount=None, pipelined=False, framesInFlight=4, partHalo=0,
+                     cacheDir=None, cacheMaxBytes=PHOTO_CACHE_MAX_BYTES, onphotoDone=None):
+    allResults = analyzeAllphotos(inputDirectory, outputphotoDir, processesCount, pipelined, framesInFlight, partHalo,
+                                  cacheDir, cacheMaxBytes, onphotoDone)
+
+    with timedStage("save"):
+        save(allResults, outputXLSXPath)
     print(f"Analysis complete. Results saved to {outputXLSXPath}")
 
+# Анализ всех изображений каталога без сохранения в Excel.
+# onphotoDone(objectsData) вызывается для каждого изображения сразу по готовности, в порядке изображений
+def analyzeAllphotos(inputDirectory, outputphotoDir, processesCount=None, pipelined=False, framesInFlight=4, partHalo=0,
+                     cacheDir=None, cacheMaxBytes=PHOTO_CACHE_MAX_BYTES, onphotoDone=None):
+    allResults = []
+    photoPaths = [os.path.join(inputDirectory, photoName) for photoName in os.listdir(inputDirectory)
+                  if photoName.lower().endswith(('.png', '.jpg') + MAPPED_PHOTO_EXTENSIONS)]
+
+    # Один пул процессов на весь запуск; по умолчанию по числу ядер
+    with createProcessPool(processesCount) as processPool:
+        if pipelined:
+            allResults = processphotosPipelined(photoPaths, outputphotoDir, processPool, framesInFlight, partHalo,
+                                                cacheDir, cacheMaxBytes, onphotoDone)
+        else:
+            for photoPath in photoPaths:
+                objectsData = processphoto(photoPath, outputphotoDir, processPool, None, partHalo, cacheDir, cacheMaxBytes)
+                if onphotoDone is not None:
+                    onphotoDone(objectsData)
+                allResults.extend(objectsData)
+
+    return allResults
+
+XLSX_HEADERS = ['photo', 'PartIndex', 'Coordinates', 'Brightness', 'Area', 'Type']
+XLSX_MAX_ROWS = 1048576  # Предел строк на листе Excel, включая заголовок
+
+def resultRow(objectData):
+    return [
+        objectData['photo'],
+        objectData['partIndex'],
+        f"{objectData['coordinates'][0]}, {objectData['coordinates'][1]}",
+        objectData['brightness'],
+        objectData['area'],
+        objectData['type']
+    ]
+
+# Сохранение в режиме write_only: строки сразу пишутся в файл, ячейки не хранятся в памяти.
+# При достижении предела строк Excel данные продолжаются на новом листе
 def save(data, outputXLSXPath):
-    workbook = Workbook()
-    sheet = workbook.active
-    sheet.title = "Results"
-    
-    headers = ['photo', 'PartIndex', 'Coordinates', 'Brightness', 'Area', 'Type']
-    sheet.append(headers)
-
+    from openpyxl import Workbook
+    from openpyxl.utils import get_column_letter
+
+    workbook = Workbook(write_only=True)
+
+    # В режиме write_only ширину столбцов нужно задать до первой строки, поэтому максимумы длин
+    # считаются заранее по записям (без создания ячеек); для итератора остаются ширины заголовков
+    columnWidths = [len(header) for header in XLSX_HEADERS]
+    if isinstance(data, (list, tuple)):
+        for objectData in data:
+            for columnIndex, value in enumerate(resultRow(objectData)):
+                columnWidths[columnIndex] = max(columnWidths[columnIndex], len(str(value)))
+
+    def createSheet():
+        sheet = workbook.create_sheet("Results" if not workbook.worksheets else f"Results {len(workbook.worksheets) + 1}")
+        for columnIndex, columnWidth in enumerate(columnWidths, start=1):
+            sheet.column_dimensions[get_column_letter(columnIndex)].width = columnWidth + 2
+        sheet.append(XLSX_HEADERS)
+        return sheet
+
+    sheet = createSheet()
+    sheetRows = 1
     for objectData in data:
-        sheet.append([ 
-            objectData['photo'],
-            objectData['partIndex'],
-            f"{objectData['coordinates'][0]}, {objectData['coordinates'][1]}",
-            objectData['brightness'],
-            objectData['area'],
-            objectData['type']
-        ])
-
-    for column in sheet.columns:
-        max_length = 0
-        column = [cell for cell in column]
-        for cell in column:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = (max_length + 2)
-        sheet.column_dimensions[column[0].column_letter].width = adjusted_width
+        if sheetRows >= XLSX_MAX_ROWS:
+            sheet = createSheet()
+            sheetRows = 1
+        sheet.append(resultRow(objectData))
+        sheetRows += 1
 
     workbook.save(outputXLSXPath)
 
-def processphoto(photoPath, outputphotoDir):
-    photo = cv2.imread(photoPath)
+# Колоночное сохранение в Parquet (нужен pyarrow) для больших запусков; запись идет частями по chunkSize строк
+def saveParquet(data, outputParquetPath, chunkSize=100000):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("photo", pa.string()),
+        ("partIndex", pa.int32()),
+        ("x", pa.int64()),
+        ("y", pa.int64()),
+        ("brightness", pa.uint64()),
+        ("area", pa.int64()),
+        ("type", pa.string())
+    ])
+
+    def writeChunk(parquetWriter, chunk):
+        columns = {name: [row[index] for row in chunk] for index, name in enumerate(schema.names)}
+        parquetWriter.write_table(pa.Table.from_pydict(columns, schema=schema))
+
+    with pq.ParquetWriter(outputParquetPath, schema) as parquetWriter:
+        chunk = []
+        for objectData in data:
+            chunk.append((objectData["photo"], objectData["partIndex"],
+                          int(objectData["coordinates"][0]), int(objectData["coordinates"][1]),
+                          int(objectData["brightness"]), objectData["area"], objectData["type"]))
+            if len(chunk) >= chunkSize:
+                writeChunk(parquetWriter, chunk)
+                chunk = []
+        if chunk:
+            writeChunk(parquetWriter, chunk)
+
+# Создает пул процессов (по умолчанию по числу ядер). Трекер общей памяти запускается заранее,
+# чтобы процессы пула использовали его, а не запускали собственные
+def createProcessPool(processesCount=None):
+    if os.name != "nt":
+        resource_tracker.ensure_running()
+    return multiprocessing.Pool(processes=processesCount or os.cpu_count(), initializer=initializeWorker,
+                                initargs=(stageTimings is not None, profileDir))
+
+# Конвейерная обработка: одновременно в работе не более framesInFlight изображений.
+# Пока одни изображения анализируются, следующие уже декодируются, а части готовых записываются
+# отдельным пулом потоков (cv2.imread/cv2.imwrite отпускают GIL)
+def processphotosPipelined(photoPaths, outputphotoDir, processPool, framesInFlight=4, partHalo=0,
+                           cacheDir=None, cacheMaxBytes=PHOTO_CACHE_MAX_BYTES, onphotoDone=None):
+    allResults = []
+
+    with ThreadPoolExecutor(max_workers=framesInFlight) as framePool, \
+         ThreadPoolExecutor(max_workers=os.cpu_count()) as writePool:
+        framesResults = framePool.map(
+            lambda photoPath: processphoto(photoPath, outputphotoDir, processPool, writePool, partHalo,
+                                           cacheDir, cacheMaxBytes), photoPaths)
+        for objectsData in framesResults:  # Результаты собираются в порядке изображений
+            if onphotoDone is not None:
+                onphotoDone(objectsData)
+            allResults.extend(objectsData)
+
+    return allResults
+
+def processphoto(photoPath, outputphotoDir, processPool=None, writePool=None, partHalo=0,
+                 cacheDir=None, cacheMaxBytes=PHOTO_CACHE_MAX_BYTES):
     photoName = os.path.basename(photoPath)
-    
     photoOutputDir = os.path.join(outputphotoDir, os.path.splitext(photoName)[0])
+
+    # Неизмененное изображение берется из кэша без анализа и без перезаписи частей
+    if cacheDir is not None:
+        cacheKey = photoCacheKey(photoPath, partHalo)
+        cachedObjectsData = loadCachedphoto(cacheDir, cacheKey, photoOutputDir)
+        if cachedObjectsData is not None:
+            return cachedObjectsData
+
+    if processPool is None:
+        with createProcessPool() as processPool:
+            return processphoto(photoPath, outputphotoDir, processPool, writePool, partHalo, cacheDir, cacheMaxBytes)
+
     os.makedirs(photoOutputDir, exist_ok=True)
-    
-    photoParts = splitphoto(photo, 1000)
 
-    # Создаем аргументы для многопроцессорной обработки
-    arguments = [(part, partIndex, photoName, offsetX, offsetY) 
+    if photoPath.lower().endswith(MAPPED_PHOTO_EXTENSIONS):
+        allObjectsData, partNames = processMappedphoto(photoPath, photoOutputDir, processPool, writePool, partHalo)
+    else:
+        allObjectsData, partNames = processSharedphoto(photoPath, photoOutputDir, processPool, writePool, partHalo)
+
+    if cacheDir is not None:
+        storeCachedphoto(cacheDir, cacheKey, partNames, allObjectsData, cacheMaxBytes)
+
+    return allObjectsData
+
+# Изображение декодируется целиком и кладется в общую память, чтобы не копировать части в процессы
+def processSharedphoto(photoPath, photoOutputDir, processPool, writePool=None, partHalo=0):
+    photoName = os.path.basename(photoPath)
+    with timedStage("decode"):
+        decodedPhoto = cv2.imread(photoPath)
+
+    sharedPhoto = shared_memory.SharedMemory(create=True, size=decodedPhoto.nbytes)
+    try:
+        with timedStage("sharedCopy"):
+            photo = np.ndarray(decodedPhoto.shape, dtype=np.uint8, buffer=sharedPhoto.buf)
+            np.copyto(photo, decodedPhoto)
+        del decodedPhoto
+
+        with timedStage("splitphoto"):
+            photoParts = splitphoto(photo, PART_SIZE)
+        partNames = [f"{partIndex + 1}.png" for _, _, _, partIndex in photoParts]
+
+        # Создаем аргументы для многопроцессорной обработки: только имя блока и координаты частей
+        arguments = [(sharedPhoto.name, photo.shape, part.shape, partIndex, photoName, offsetX, offsetY, partHalo)
+                     for part, offsetX, offsetY, partIndex in photoParts]
+
+        with timedStage("analysis"):
+            results = processPool.map(analyzeSharedPhotoPart, arguments)  # Параллельный анализ частей изображения
+
+        # Части должны быть записаны до освобождения общей памяти
+        allObjectsData = savephotoParts(photoParts, results, photoName, photoOutputDir, writePool, savephotoPart)
+    finally:
+        # Представления должны быть освобождены до закрытия блока общей памяти
+        photo = photoParts = None
+        sharedPhoto.close()
+        sharedPhoto.unlink()
+
+    return allObjectsData, partNames
+
+# Несжатое изображение не читается целиком: процессы читают свои части из файла, а при записи
+# размеченных частей в память загружается только записываемая часть
+def processMappedphoto(photoPath, photoOutputDir, processPool, writePool=None, partHalo=0):
+    photoName = os.path.basename(photoPath)
+    photo = openMappedphoto(photoPath)
+    with timedStage("splitphoto"):
+        photoParts = splitphoto(photo, PART_SIZE)  # Срезы memmap, данные еще не прочитаны
+
+    arguments = [(photoPath, photo.shape, part.shape, partIndex, photoName, offsetX, offsetY, partHalo)
                  for part, offsetX, offsetY, partIndex in photoParts]
-    
-    # Создаем пул процессов для многопроцессорной обработки
-    with multiprocessing.Pool(processes=16) as processPool:
-        results = processPool.map(analyzePhotoPart, arguments)  # Параллельный анализ частей изображения
 
+    with timedStage("analysis"):
+        results = processPool.map(analyzeMappedPhotoPart, arguments)
+
+    saveMappedphotoPart = lambda part, *arguments: savephotoPart(toBGRphoto(part), *arguments)
+    allObjectsData = savephotoParts(photoParts, results, photoName, photoOutputDir, writePool, saveMappedphotoPart)
+    return allObjectsData, [f"{partIndex + 1}.png" for _, _, _, partIndex in photoParts]
+
+# Объединяет данные объектов всех частей и записывает размеченные части (параллельно, если передан writePool)
+def savephotoParts(photoParts, results, photoName, photoOutputDir, writePool, saveFunction):
     allObjectsData = []  # Список для хранения всех данных об объектах
-    for objectData, contourCenters in results:  # Объединяем данные объектов и контуры
+    for objectData, contourCenters, partMetrics in results:  # Объединяем данные объектов и контуры
         allObjectsData.extend(objectData)
+        recordPartMetrics(partMetrics)
 
-    for (part, offsetX, offsetY, partIndex), (_, contourCenters) in zip(photoParts, results):
-        savephotoPart(part, partIndex, photoName, photoOutputDir, contourCenters)
+    if writePool is None:
+        for (part, offsetX, offsetY, partIndex), (_, contourCenters, _) in zip(photoParts, results):
+            saveFunction(part, partIndex, photoName, photoOutputDir, contourCenters)
+    else:
+        writeTasks = [writePool.submit(saveFunction, part, partIndex, photoName, photoOutputDir, contourCenters)
+                      for (part, offsetX, offsetY, partIndex), (_, contourCenters, _) in zip(photoParts, results)]
+        for writeTask in writeTasks:
+            writeTask.result()
 
     return allObjectsData
 
+# Ключ кэша: содержимое файла, имя изображения и все параметры анализа, включая правила классификации
+def photoCacheKey(photoPath, partHalo=0):
+    keyHash = hashlib.sha256()
+    with open(photoPath, "rb") as photoFile:
+        for chunk in iter(lambda: photoFile.read(1 << 20), b""):
+            keyHash.update(chunk)
+
+    parameters = (PHOTO_CACHE_VERSION, os.path.basename(photoPath), PHOTO_THRESHOLD, BLUR_KERNEL, PART_SIZE, partHalo,
+                  inspect.getsource(classification), inspect.getsource(classificationBatch))
+    keyHash.update(repr(parameters).encode())
+    return keyHash.hexdigest()
+
+# Возвращает сохраненный список объектов или None, если записи нет или части изображения были удалены
+def loadCachedphoto(cacheDir, cacheKey, photoOutputDir):
+    cachePath = os.path.join(cacheDir, f"{cacheKey}.pkl")
+    try:
+        with open(cachePath, "rb") as cacheFile:
+            partNames, objectsData = pickle.load(cacheFile)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+
+    if not all(os.path.exists(os.path.join(photoOutputDir, partName)) for partName in partNames):
+        return None
+
+    os.utime(cachePath)  # Время использования записи для вытеснения самых старых
+    return objectsData
+
+def storeCachedphoto(cacheDir, cacheKey, partNames, objectsData, cacheMaxBytes=PHOTO_CACHE_MAX_BYTES):
+    os.makedirs(cacheDir, exist_ok=True)
+    cachePath = os.path.join(cacheDir, f"{cacheKey}.pkl")
+
+    # Запись через временный файл, чтобы параллельные потоки не видели недописанную запись
+    temporaryPath = f"{cachePath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporaryPath, "wb") as cacheFile:
+        pickle.dump((partNames, objectsData), cacheFile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporaryPath, cachePath)
+
+    evictphotoCache(cacheDir, cacheMaxBytes)
+
+# Удаляет давно не использованные записи, пока размер кэша больше cacheMaxBytes
+def evictphotoCache(cacheDir, cacheMaxBytes=PHOTO_CACHE_MAX_BYTES):
+    cacheEntries = []
+    for entry in os.scandir(cacheDir):
+        if entry.name.endswith(".pkl"):
+            try:
+                entryStat = entry.stat()
+            except FileNotFoundError:
+                continue
+            cacheEntries.append((entryStat.st_mtime, entryStat.st_size, entry.path))
+
+    cacheSize = sum(entrySize for _, entrySize, _ in cacheEntries)
+    for _, entrySize, entryPath in sorted(cacheEntries):
+        if cacheSize <= cacheMaxBytes:
+            break
+        try:
+            os.remove(entryPath)
+        except FileNotFoundError:
+            pass
+        cacheSize -= entrySize
+
+# Полностью очищает кэш результатов
+def clearphotoCache(cacheDir):
+    if not os.path.isdir(cacheDir):
+        return
+    for entry in os.scandir(cacheDir):
+        if entry.name.endswith((".pkl", ".tmp")):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
 def splitphoto(photo, partSize):
-    photoHeight, photoWidth, _ = photo.shape
+    photoHeight, photoWidth = photo.shape[:2]
     photoParts = []
     
     partIndex = 0
@@ -136,23 +655,121 @@ def splitphoto(photo, partSize):
     return photoParts
 
 def savephotoPart(part, partIndex, photoName, outputDir, contourCenters):
-    for (centerX, centerY, radius, objectType) in contourCenters:
-        largerRadius = int(radius * 1.5)
-        
-        if objectType == "Star":
-            color = (255, 0, 0)
-        elif objectType == "Planet":
-            color = (0, 0, 255)
-        elif objectType == "A bright star":
-            color = (0, 255, 0)
-
-        cv2.circle(part, (centerX, centerY), largerRadius, color, 4)
+    with timedStage("drawContours"):
+        for (centerX, centerY, radius, objectType) in contourCenters:
+            largerRadius = int(radius * 1.5)
+
+            if objectType == "Star":
+                color = (255, 0, 0)
+            elif objectType == "Planet":
+                color = (0, 0, 255)
+            elif objectType == "A bright star":
+                color = (0, 255, 0)
+
+            cv2.circle(part, (centerX, centerY), largerRadius, color, 4)
 
     partphotoName = f"{partIndex + 1}.png"
     partphotoPath = os.path.join(outputDir, partphotoName)
-    cv2.imwrite(partphotoPath, part)
+    with timedStage("writePng"):
+        cv2.imwrite(partphotoPath, part)
+
+STREAM_FIELDS = ["photo", "partIndex", "x", "y", "brightness", "area", "type"]
+
+# Возвращает функцию, которая построчно пишет объекты изображения в outputFile (JSON Lines или CSV)
+def createRecordWriter(outputFile, outputFormat="jsonl"):
+    if outputFormat == "csv":
+        csvWriter = csv.DictWriter(outputFile, fieldnames=STREAM_FIELDS)
+        csvWriter.writeheader()
+        writeRecord = csvWriter.writerow
+    elif outputFormat == "jsonl":
+        writeRecord = lambda record: outputFile.write(json.dumps(record, ensure_ascii=False) + "\n")
+    else:
+        raise ValueError(f"Неизвестный формат вывода: {outputFormat}")
+
+    def writeRecords(objectsData):
+        for objectData in objectsData:
+            writeRecord({
+                "photo": objectData["photo"],
+                "partIndex": objectData["partIndex"],
+                "x": int(objectData["coordinates"][0]),
+                "y": int(objectData["coordinates"][1]),
+                "brightness": int(objectData["brightness"]),
+                "area": objectData["area"],
+                "type": objectData["type"]
+            })
+        outputFile.flush()  # Чтобы следующие задачи могли читать результаты до конца анализа
+
+    return writeRecords
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Анализ космических снимков без графического интерфейса")
+    parser.add_argument("inputDirectory", help="каталог с изображениями .png/.jpg/.npy/.fits")
+    parser.add_argument("--xlsx", dest="outputXLSXPath", help="путь для statistic.xlsx (по умолчанию не сохраняется)")
+    parser.add_argument("--parquet", dest="outputParquetPath", help="путь для сохранения результатов в Parquet (нужен pyarrow)")
+    parser.add_argument("--parts-dir", dest="outputphotoDir", default="photo_parts", help="каталог для размеченных частей")
+    parser.add_argument("--stream", dest="streamPath", help="файл для построчного вывода объектов, '-' для stdout")
+    parser.add_argument("--stream-format", dest="streamFormat", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument("--processes", dest="processesCount", type=int, help="число процессов (по умолчанию число ядер)")
+    parser.add_argument("--pipelined", action="store_true", help="конвейерная обработка нескольких изображений")
+    parser.add_argument("--frames-in-flight", dest="framesInFlight", type=int, default=4)
+    parser.add_argument("--halo", dest="partHalo", type=int, default=0, help="перекрытие частей в пикселях")
+    parser.add_argument("--cache-dir", dest="cacheDir", help="каталог кэша результатов")
+    parser.add_argument("--cache-max-bytes", dest="cacheMaxBytes", type=int, default=PHOTO_CACHE_MAX_BYTES)
+    parser.add_argument("--clear-cache", dest="clearCache", action="store_true", help="очистить кэш перед анализом")
+    parser.add_argument("--metrics", action="store_true", help="вывести в stderr время этапов и самые медленные части")
+    parser.add_argument("--metrics-json", dest="metricsPath", help="сохранить итог замеров в JSON")
+    parser.add_argument("--profile-dir", dest="profileDir", help="сохранять профиль cProfile каждой части в каталог")
+    return parser.parse_args(argv)
+
+# Точка входа для запуска без графического интерфейса
+def main(argv=None):
+    arguments = parseArguments(argv)
+
+    if arguments.clearCache and arguments.cacheDir:
+        clearphotoCache(arguments.cacheDir)
+
+    os.makedirs(arguments.outputphotoDir, exist_ok=True)
+
+    instrumented = arguments.metrics or arguments.metricsPath or arguments.profileDir
+    if instrumented:
+        enableInstrumentation(arguments.profileDir)
+
+    streamFile = None
+    onphotoDone = None
+    if arguments.streamPath == "-":
+        onphotoDone = createRecordWriter(sys.stdout, arguments.streamFormat)
+    elif arguments.streamPath:
+        streamFile = open(arguments.streamPath, "w", encoding="utf-8", newline="")
+        onphotoDone = createRecordWriter(streamFile, arguments.streamFormat)
+
+    try:
+        allResults = analyzeAllphotos(arguments.inputDirectory, arguments.outputphotoDir, arguments.processesCount,
+                                      arguments.pipelined, arguments.framesInFlight, arguments.partHalo,
+                                      arguments.cacheDir, arguments.cacheMaxBytes, onphotoDone)
+    finally:
+        if streamFile is not None:
+            streamFile.close()
+
+    if arguments.outputXLSXPath:
+        with timedStage("save"):
+            save(allResults, arguments.outputXLSXPath)
+    if arguments.outputParquetPath:
+        with timedStage("saveParquet"):
+            saveParquet(allResults, arguments.outputParquetPath)
+    # Сообщение в stderr, чтобы не смешивать его с потоковым выводом в stdout
+    print(f"Analysis complete. Objects found: {len(allResults)}", file=sys.stderr)
+
+    if instrumented:
+        summary = instrumentationSummary()
+        if arguments.metrics:
+            print(formatInstrumentationSummary(summary), file=sys.stderr)
+        if arguments.metricsPath:
+            with open(arguments.metricsPath, "w", encoding="utf-8") as metricsFile:
+                json.dump(summary, metricsFile, ensure_ascii=False, indent=4)
 
 def analyze():
+    from tkinter import messagebox
+
     global inputDirectory, outputXLSXPath, outputphotoDir
     if not inputDirectory:
         inputDirectory = 'photo'
@@ -168,12 +785,16 @@ def analyze():
     messagebox.showinfo("Анализ завершен", f"Результаты сохранены в {outputXLSXPath}")
 
 def choosephotos():
+    from tkinter import filedialog
+
     global inputDirectory
     inputDirectory = filedialog.askdirectory()
     if inputDirectory:
         label_selected_photos.config(text=f"Выбраны изображения: {inputDirectory}")
 
 def savePath():
+    from tkinter import filedialog
+
     global outputXLSXPath
     output_directory = filedialog.askdirectory()
     if output_directory:
@@ -181,6 +802,8 @@ def savePath():
         label_save_path.config(text=f"Сохранить в: {outputXLSXPath}")
 
 def create_interface():
+    import tkinter as tk
+
     global btn_analyze, label_selected_photos, label_save_path
     
     root = tk.Tk()
@@ -214,10 +837,15 @@ def create_interface():
 
     return root
 
-if __name__ == "__main__":
-    inputDirectory = ''
-    outputXLSXPath = ''
-    outputphotoDir = ''
+# tkinter и openpyxl импортируются только при использовании интерфейса и сохранении в Excel
+inputDirectory = ''
+outputXLSXPath = ''
+outputphotoDir = ''
 
-    root = create_interface()
-    root.mainloop()
+if __name__ == "__main__":
+    # Без аргументов запускается графический интерфейс, с аргументами — командная строка
+    if len(sys.argv) > 1:
+        main()
+    else:
+        root = create_interface()
+        root.mainloop()
@@ -0,0 +1,49 @@
+from collections import Counter
+
+import cv2
+import pytest
+
+import parallel_processing_space as space
+from benchmark_space import generateStarField
+
+FRAME_WIDTH = 2000
+FRAME_HEIGHT = 2000
+OBJECTS_COUNT = 600
+
+
+def objectsMultiset(objectsData):
+    return Counter((tuple(objectData["coordinates"]), int(objectData["brightness"]), objectData["area"], objectData["type"])
+                   for objectData in objectsData)
+
+
+@pytest.fixture(scope="module")
+def starField(tmp_path_factory):
+    photo, _ = generateStarField(FRAME_WIDTH, FRAME_HEIGHT, OBJECTS_COUNT)
+    photoPath = str(tmp_path_factory.mktemp("input") / "field.png")
+    cv2.imwrite(photoPath, photo)
+    wholeObjectsData, _ = space.analyzePhotoPart((cv2.imread(photoPath), 0, "field.png", 0, 0))
+    return photoPath, objectsMultiset(wholeObjectsData)
+
+
+@pytest.fixture(scope="module")
+def processPool():
+    with space.createProcessPool(2) as pool:
+        yield pool
+
+
+# Части с перекрытием дают те же объекты, что и анализ всего кадра
+def test_halo_tiles_match_whole_frame(starField, processPool, tmp_path):
+    photoPath, wholeObjects = starField
+    objectsData = space.processphoto(photoPath, str(tmp_path), processPool, partHalo=64)
+
+    assert sum(wholeObjects.values()) == OBJECTS_COUNT
+    assert objectsMultiset(objectsData) == wholeObjects
+
+
+# Без перекрытия объекты на стыках частей находятся несколько раз с неполной площадью и яркостью
+def test_hard_tiles_split_seam_objects(starField, processPool, tmp_path):
+    photoPath, wholeObjects = starField
+    objectsData = space.processphoto(photoPath, str(tmp_path), processPool, partHalo=0)
+
+    assert len(objectsData) > sum(wholeObjects.values())
+    assert objectsMultiset(objectsData) != wholeObjects
@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import time
+
+import protocol
+import server
+
+MARKER = b"bench|"
+
+# Читает поток клиента и считает сообщения с меткой, пока не получит все
+async def receive_messages(reader, expected):
+    received = 0
+    tail = b""
+    while received < expected:
+        data = await reader.read(1 << 16)
+        if not data:
+            break
+        data = tail + data
+        received += data.count(MARKER)
+        tail = data[-(len(MARKER) - 1):]
+    return received
+
+async def connect(port, username, room, framed):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    if framed:
+        writer.write(protocol.encode_frame(protocol.JOIN, f"{username}\n{room}"))
+    else:
+        writer.write(f"{username}\n{room}\n".encode())
+    await writer.drain()
+    return reader, writer
+
+# Один отправитель, members получателей в одной комнате; сервер работает в этом же процессе.
+# framed — клиенты используют протокол кадров вместо строк
+async def run_benchmark(members, messages, message_size, framed=False):
+    server.clients.clear()
+    server.room_histories.clear()
+    server.OUTBOUND_QUEUE_SIZE = messages + members + 10  # Замер пропускной способности без отбрасывания
+
+    handlers = set()
+
+    async def handle_client(reader, writer):
+        handlers.add(asyncio.current_task())
+        try:
+            await server.handle_client(reader, writer)
+        finally:
+            handlers.discard(asyncio.current_task())
+
+    chat_server = await asyncio.start_server(handle_client, "127.0.0.1", 0)
+    port = chat_server.sockets[0].getsockname()[1]
+
+    connections = [await connect(port, f"user{index}", "bench", framed) for index in range(members)]
+    sender_reader, sender_writer = connections[0]
+    while sum(len(room) for room in server.clients.values()) < members:
+        await asyncio.sleep(0.01)
+
+    payload = MARKER + b"x" * max(message_size - len(MARKER), 0)
+    payload = protocol.encode_frame(protocol.CHAT, payload) if framed else payload + b"\n"
+    receivers = [asyncio.create_task(receive_messages(reader, messages)) for reader, _ in connections]
+
+    start_time = time.perf_counter()
+    for _ in range(messages):
+        sender_writer.write(payload)
+        await sender_writer.drain()
+    received = await asyncio.gather(*receivers)
+    elapsed = time.perf_counter() - start_time
+
+    for _, writer in connections:
+        writer.close()
+    # Ожидание, пока сервер обработает отключения всех клиентов
+    while handlers:
+        await asyncio.sleep(0.01)
+    chat_server.close()
+    await chat_server.wait_closed()
+
+    return {
+        "members": members,
+        "messages": messages,
+        "messagesPerSecond": messages / elapsed,
+        "deliveriesPerSecond": sum(received) / elapsed,
+        "lost": members * messages - sum(received)
+    }
+
+async def main(arguments):
+    for members in arguments.members:
+        result = await run_benchmark(members, arguments.messages, arguments.message_size, arguments.framed)
+        print(f"участников {result['members']:>5}: {result['messagesPerSecond']:>9.0f} сообщ/с, "
+              f"{result['deliveriesPerSecond']:>10.0f} доставок/с, потеряно {result['lost']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замер скорости рассылки сообщений в комнате чата")
+    parser.add_argument("--members", type=lambda text: [int(value) for value in text.split(",")], default=[10, 100, 500])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--message-size", dest="message_size", type=int, default=100)
+    parser.add_argument("--framed", action="store_true", help="клиенты используют протокол кадров")
+    arguments = parser.parse_args()
+
+    asyncio.run(main(arguments))
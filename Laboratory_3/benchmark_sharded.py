@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import protocol
+from benchmark_broadcast import MARKER, connect, receive_messages
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def wait_for_server(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Сервер не запустился")
+
+# Комнаты одного процесса нагрузки: в каждой members участников, первый из них отправляет messages сообщений
+async def load_rooms(port, rooms, members, messages, message_size, barrier):
+    connections = {room: [await connect(port, f"{room}_user{index}", room, True) for index in range(members)]
+                   for room in rooms}
+    # Время на распространение состава комнат по шине между воркерами
+    await asyncio.sleep(1)
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+
+    payload = protocol.encode_frame(protocol.CHAT, MARKER + b"x" * max(message_size - len(MARKER), 0))
+    receivers = [asyncio.create_task(receive_messages(reader, messages))
+                 for room_connections in connections.values() for reader, _ in room_connections]
+
+    async def send(writer):
+        for _ in range(messages):
+            writer.write(payload)
+            await writer.drain()
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(send(room_connections[0][1]) for room_connections in connections.values()))
+    received = await asyncio.gather(*receivers)
+    elapsed = time.perf_counter() - start_time
+
+    for room_connections in connections.values():
+        for _, writer in room_connections:
+            writer.close()
+    return sum(received), elapsed
+
+def load_process(port, rooms, members, messages, message_size, barrier, results):
+    results.put(asyncio.run(load_rooms(port, rooms, members, messages, message_size, barrier)))
+
+# Сервер с workers воркерами под нагрузкой из clientProcesses процессов
+def run_load(workers, rooms, members, messages, message_size, client_processes):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, SERVER_PATH, "--host", "127.0.0.1", "--port", str(port),
+                               "--workers", str(workers), "--log-level", "WARNING"])
+    try:
+        wait_for_server(port)
+        time.sleep(0.5)  # Остальные воркеры открывают порт чуть позже первого
+
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(client_processes)
+        results = context.Queue()
+        room_names = [f"room{index}" for index in range(rooms)]
+        processes = [context.Process(target=load_process,
+                                     args=(port, room_names[index::client_processes], members, messages,
+                                           message_size, barrier, results))
+                     for index in range(client_processes)]
+        for process in processes:
+            process.start()
+        process_results = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    delivered = sum(received for received, _ in process_results)
+    elapsed = max(elapsed for _, elapsed in process_results)
+    return {
+        "workers": workers,
+        "deliveriesPerSecond": delivered / elapsed,
+        "lost": rooms * members * messages - delivered
+    }
+
+def main(arguments):
+    baseline = None
+    for workers in arguments.workers:
+        result = run_load(workers, arguments.rooms, arguments.members, arguments.messages,
+                          arguments.message_size, arguments.client_processes)
+        baseline = baseline or result["deliveriesPerSecond"] / workers
+        efficiency = result["deliveriesPerSecond"] / (baseline * workers)
+        print(f"воркеров {workers:>3}: {result['deliveriesPerSecond']:>10.0f} доставок/с, "
+              f"эффективность масштабирования {efficiency:.2f}, потеряно {result['lost']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сервера чата в режиме нескольких процессов")
+    parser.add_argument("--workers", type=lambda text: [int(value) for value in text.split(",")],
+                        default=sorted({1, 2, os.cpu_count()}))
+    parser.add_argument("--rooms", type=int, default=40)
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--message-size", dest="message_size", type=int, default=100)
+    parser.add_argument("--client-processes", dest="client_processes", type=int, default=os.cpu_count())
+    main(parser.parse_args())
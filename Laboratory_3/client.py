@@ -1,58 +1,296 @@
 import asyncio
+import queue
+import random
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
 import threading
+from collections import deque
 from datetime import datetime
 
+import protocol
+
+# Протокол кадров (protocol.py); False — строковый режим совместимости со старыми серверами
+USE_FRAMES = True
+READ_CHUNK_SIZE = 1 << 16
+SERVER_PORT = 8888
+
+# Переподключение: предельная пауза между попытками растет вдвое от RECONNECT_DELAY_MIN до RECONNECT_DELAY_MAX,
+# а фактическая пауза выбирается случайно от нуля до нее, чтобы клиенты не переподключались к серверу одновременно
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 30
+# Неотправленные сообщения ждут подключения в очереди не длиннее OUTBOUND_QUEUE_SIZE (самые старые отбрасываются).
+# В режиме кадров отправленные сообщения хранятся до подтверждения сервером и после переподключения отправляются снова
+OUTBOUND_QUEUE_SIZE = 500
+# После переподключения сервер повторяет историю комнаты; уже показанные сообщения
+# (среди последних RECENT_MESSAGES) пропускаются до получения списка активных пользователей
+RECENT_MESSAGES = 500
+
+# Виджеты Tk можно менять только из потока Tk. Поток asyncio кладет события в ui_events,
+# а цикл Tk раз в UI_UPDATE_INTERVAL мс забирает до UI_BATCH_LIMIT событий и вставляет
+# все сообщения одним вызовом. В окне чата хранится не больше SCROLLBACK_LINES строк
+UI_UPDATE_INTERVAL = 50
+UI_BATCH_LIMIT = 5000
+UI_QUEUE_LIMIT = 20000
+SCROLLBACK_LINES = 5000
+ui_events = queue.SimpleQueue()  # Элементы: (событие, данные)
+
 asyncio_loop = None
 reader = None
 writer = None
 username = None
+current_room = None
+# Активные пользователи комнаты: {имя: число подключений}, порядок — порядок входа
+active_users = {}
+# Режим кадров: сколько сообщений отправлено через текущее подключение и сколько из них сервер подтвердил
+sent_messages = 0
+acknowledged_messages = 0
+outbound = deque()  # Сообщения, ожидающие отправки
+unacknowledged = deque()  # Режим кадров: отправленные, но еще не подтвержденные сообщения
+has_outbound = asyncio.Event()
+connection_task = None
+stopping = False
+replaying = False
+recent_messages = deque(maxlen=RECENT_MESSAGES)
+
+# Обновляет виджет активных пользователей по текущему списку
+def show_active_users(active_users_widget):
+    active_users_widget.config(state=tk.NORMAL)
+    active_users_widget.delete(1.0, tk.END)
+    active_users_widget.insert(tk.END, f"Активные пользователи в комнате {current_room}: {', '.join(active_users)}\n")
+    active_users_widget.config(state=tk.DISABLED)
+
+def add_active_user(user):
+    active_users[user] = active_users.get(user, 0) + 1
+
+def remove_active_user(user):
+    if active_users.get(user, 0) > 1:
+        active_users[user] -= 1
+    else:
+        active_users.pop(user, None)
+
+def set_active_users(users):
+    active_users.clear()
+    for user in users:
+        if user:
+            add_active_user(user)
+
+# Изменение присутствия: "=" — полный список users, "+" — вход users, "-" — выход users
+def apply_presence_change(change, users):
+    if change == "=":
+        set_active_users(users)
+    elif change == "+":
+        add_active_user(users)
+    elif change == "-":
+        remove_active_user(users)
+
+# Строковый режим: разбирает сообщение о присутствии — полный список или изменение. Возвращает None для обычных сообщений
+def parse_presence(message):
+    snapshot_prefix = f"Активные пользователи в комнате {current_room}: "
+    joined_prefix = f"Пользователь вошел в комнату {current_room}: "
+    left_prefix = f"Пользователь вышел из комнаты {current_room}: "
+
+    if message.startswith(snapshot_prefix):
+        return "=", message[len(snapshot_prefix):].split(", ")
+    if message.startswith(joined_prefix):
+        return "+", message[len(joined_prefix):]
+    if message.startswith(left_prefix):
+        return "-", message[len(left_prefix):]
+    return None
+
+# Режим кадров: "=" + имена через "\n", "+имя" или "-имя"
+def parse_presence_frame(payload):
+    change, users = payload[:1], payload[1:]
+    return change, users.split("\n") if change == "=" else users
+
+# Вызывается в цикле Tk: забирает накопившиеся события и обновляет виджеты один раз за проход
+def process_ui_events():
+    messages = []
+    presence_changed = False
+    for _ in range(UI_BATCH_LIMIT):
+        try:
+            event, data = ui_events.get_nowait()
+        except queue.Empty:
+            break
+        if event == "message":
+            messages.append(data)
+        elif event == "presence":
+            apply_presence_change(*data)
+            presence_changed = True
+        elif event == "error":
+            messagebox.showerror("Ошибка подключения", data)
+        elif event == "quit":
+            root.destroy()
+            return
+
+    if messages:
+        show_messages(messages, text_widget)
+    if presence_changed:
+        show_active_users(active_users_widget)
+    root.after(UI_UPDATE_INTERVAL, process_ui_events)
+
+# Все сообщения прохода — одной вставкой; старые строки сверх SCROLLBACK_LINES удаляются.
+# Прокрутка вниз, только если пользователь и так был внизу и не читает историю
+def show_messages(messages, text_widget):
+    at_bottom = text_widget.yview()[1] >= 1.0
+    text_widget.insert(tk.END, "\n".join(messages) + "\n")
+    lines_count = int(text_widget.index("end-1c").split(".")[0]) - 1
+    if lines_count > SCROLLBACK_LINES:
+        text_widget.delete("1.0", f"{lines_count - SCROLLBACK_LINES + 1}.0")
+    if at_bottom:
+        text_widget.see(tk.END)
+
+# Если интерфейс не успевает, чтение из сокета приостанавливается: данные копятся в буферах TCP,
+# и сервер применяет к клиенту свою политику для медленных клиентов
+async def wait_for_ui():
+    while ui_events.qsize() > UI_QUEUE_LIMIT:
+        await asyncio.sleep(UI_UPDATE_INTERVAL / 1000)
 
 # Функция для получения сообщений от сервера
-async def get_messages(reader, text_widget, active_users_widget):
+async def get_messages(reader):
+    if USE_FRAMES:
+        await get_frames(reader)
+        return
     while True:
-        data = await reader.read(100)
+        await wait_for_ui()
+        data = await reader.readline()
         if not data:
             break
-        message = data.decode()
-
-        if message.startswith("Активные пользователи в комнате"):
-            active_users_widget.config(state=tk.NORMAL)
-            active_users_widget.delete(1.0, tk.END)
-            active_users_widget.insert(tk.END, message + '\n')
-            active_users_widget.config(state=tk.DISABLED)
-        elif "присоединился к комнате" in message or "покинул комнату" in message:
-            text_widget.insert(tk.END, f"{message}\n")
-            text_widget.see(tk.END)
+        message = data.decode(errors="replace").rstrip("\n")
+
+        presence = parse_presence(message)
+        if presence is None:
+            receive_message(message)
         else:
-            text_widget.insert(tk.END, f"{message}\n")
-            text_widget.see(tk.END)
+            receive_presence(presence)
 
-# Функция для отправки сообщений на сервер
-async def send_message(writer, message):
+# Режим кадров: тип сообщения задан типом кадра, текст не нужно разбирать
+async def get_frames(reader):
+    parser = protocol.FrameParser()
+    while True:
+        await wait_for_ui()
+        data = await reader.read(READ_CHUNK_SIZE)
+        if not data:
+            break
+        for frame_type, payload in parser.feed(data):
+            if frame_type == protocol.ACK:
+                acknowledge_messages(protocol.ACK_COUNT.unpack(payload)[0])
+            elif frame_type == protocol.PRESENCE:
+                receive_presence(parse_presence_frame(protocol.decode_text(payload)))
+            elif frame_type == protocol.CHAT:
+                receive_message(protocol.decode_text(payload))
+            elif frame_type == protocol.SYSTEM:
+                ui_events.put(("message", protocol.decode_text(payload)))
+
+def receive_message(message):
+    if replaying and message in recent_messages:
+        return
+    recent_messages.append(message)
+    ui_events.put(("message", message))
+
+# Сервер присылает список активных пользователей сразу после истории комнаты
+def receive_presence(presence):
+    global replaying
+    if presence[0] == "=":
+        replaying = False
+    ui_events.put(("presence", presence))
+
+# Подтверждение — число сообщений, принятых сервером через текущее подключение
+def acknowledge_messages(count):
+    global acknowledged_messages
+    for _ in range(min(count - acknowledged_messages, len(unacknowledged))):
+        unacknowledged.popleft()
+    acknowledged_messages = count
+
+# Функция для отправки сообщений на сервер: сообщение ставится в очередь и уходит, как только есть подключение
+async def send_message(message):
+    # Команда /users запрашивает у сервера полный список активных пользователей; без подключения она не нужна
+    if message.strip() == "/users":
+        if writer is not None and not writer.is_closing():
+            writer.write(protocol.encode_frame(protocol.PRESENCE, "?") if USE_FRAMES else b"/users\n")
+        return
     timestamp = datetime.now().strftime("%H:%M")
-    full_message = f"{username}({timestamp}): {message}"
-    writer.write((full_message + '\n').encode())
-    await writer.drain()
+    if len(outbound) >= OUTBOUND_QUEUE_SIZE:
+        outbound.popleft()
+        ui_events.put(("message", "Очередь отправки переполнена: самое старое неотправленное сообщение отброшено"))
+    outbound.append(f"{username}({timestamp}): {message}")
+    has_outbound.set()
+
+# Отправляет очередь сообщений через текущее подключение; все накопившиеся сообщения — одной записью
+async def send_outbound(writer):
+    global sent_messages
+    while True:
+        await has_outbound.wait()
+        has_outbound.clear()
+        batch = [outbound.popleft() for _ in range(len(outbound))]
+        if USE_FRAMES:
+            unacknowledged.extend(batch)
+            sent_messages += len(batch)
+            writer.writelines([protocol.encode_frame(protocol.CHAT, message) for message in batch])
+        else:
+            writer.writelines([(message + '\n').encode() for message in batch])
+        await writer.drain()
 
 def on_send_button_click():
     message = entry_widget.get()
     entry_widget.delete(0, tk.END)
-    asyncio.run_coroutine_threadsafe(send_message(writer, message), asyncio_loop)
+    asyncio.run_coroutine_threadsafe(send_message(message), asyncio_loop)
 
-async def register_client(ip, username, room):
-    global reader, writer
-    try:
-        reader, writer = await asyncio.open_connection(ip, 8888)
+async def send_registration(writer, username, room):
+    if USE_FRAMES:
+        writer.write(protocol.encode_frame(protocol.JOIN, f"{username}\n{room}"))
+    else:
         writer.write(f"{username}\n".encode())
         await writer.drain()
         writer.write(f"{room}\n".encode())
-        await writer.drain()
-        print(f"Клиент {username} зарегистрирован в комнате {room}")
-        asyncio.create_task(get_messages(reader, text_widget, active_users_widget))
-    except Exception as e:
-        messagebox.showerror("Ошибка подключения", f"Не удалось подключиться к серверу: {e}")
+    await writer.drain()
+
+# Подключение с повторной регистрацией в той же комнате после каждого обрыва
+async def run_connection(ip, username, room):
+    global reader, writer, replaying, sent_messages, acknowledged_messages
+    delay = RECONNECT_DELAY_MIN
+    connected_before = False
+    while not stopping:
+        try:
+            reader, writer = await asyncio.open_connection(ip, SERVER_PORT)
+            await send_registration(writer, username, room)
+        except OSError as e:
+            if not connected_before:
+                ui_events.put(("error", f"Не удалось подключиться к серверу: {e}"))
+        else:
+            print(f"Клиент {username} зарегистрирован в комнате {room}")
+            replaying = connected_before
+            connected_before = True
+            delay = RECONNECT_DELAY_MIN
+
+            # Неподтвержденные сообщения прошлого подключения отправляются снова, перед новыми
+            sent_messages = acknowledged_messages = 0
+            outbound.extendleft(reversed(unacknowledged))
+            unacknowledged.clear()
+            while len(outbound) > OUTBOUND_QUEUE_SIZE:
+                outbound.popleft()
+            if outbound:
+                has_outbound.set()
+
+            sender = asyncio.create_task(send_outbound(writer))
+            try:
+                await get_messages(reader)
+            except (ConnectionError, protocol.ProtocolError):
+                pass
+            finally:
+                sender.cancel()
+                writer.close()
+
+        if stopping:
+            break
+        pause = random.uniform(0, delay)
+        ui_events.put(("message", f"Нет соединения с сервером, повторное подключение через {pause:.1f} с"))
+        await asyncio.sleep(pause)
+        delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+async def register_client(ip, username, room):
+    global current_room, connection_task
+    current_room = room
+    connection_task = asyncio.create_task(run_connection(ip, username, room))
 
 
 def start_chat(ip, username, room):
@@ -61,8 +299,8 @@ def start_chat(ip, username, room):
 
 async def main():
     global reader, writer
-    reader, writer = await asyncio.open_connection('127.0.0.1', 8888)
-    asyncio.create_task(get_messages(reader, text_widget, active_users_widget))
+    reader, writer = await asyncio.open_connection('127.0.0.1', SERVER_PORT)
+    asyncio.create_task(get_messages(reader))
 
 def start_client():
     global asyncio_loop
@@ -113,11 +351,13 @@ def prompt_user_info():
 
 # Функция для отключения клиента
 async def disconnect_client():
-    global writer
+    global stopping
+    stopping = True
+    if connection_task:
+        connection_task.cancel()
     if writer:
         writer.close()
-        await writer.wait_closed()
-    root.destroy()
+    ui_events.put(("quit", None))
 
 def on_disconnect_button_click():
     asyncio.run_coroutine_threadsafe(disconnect_client(), asyncio_loop)
@@ -180,6 +420,7 @@ client_thread = threading.Thread(target=start_client, daemon=True)
 client_thread.start()
 
 prompt_user_info()
+root.after(UI_UPDATE_INTERVAL, process_ui_events)
 
 root.protocol("WM_DELETE_WINDOW", lambda: asyncio.run_coroutine_threadsafe(disconnect_client(), asyncio_loop))
 
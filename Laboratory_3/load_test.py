@@ -0,0 +1,211 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+from array import array
+
+from benchmark_sharded import SERVER_PATH, free_port, wait_for_server
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MARKER = b"load|"
+
+# Тысячи подключений требуют больше открытых файлов, чем обычно разрешено по умолчанию;
+# сервер, запущенный отсюда, наследует это ограничение
+def raise_open_files_limit():
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+# Память сервера (МБ): процесс и его дочерние процессы (воркеры), по /proc; только Linux
+def server_rss_mb(pid):
+    pids = [pid]
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as stat_file:
+                    if int(stat_file.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+
+    rss_kb = 0
+    for process_id in pids:
+        try:
+            with open(f"/proc/{process_id}/status") as status_file:
+                rss_kb += next(int(line.split()[1]) for line in status_file if line.startswith("VmRSS:"))
+        except (OSError, StopIteration):
+            pass
+    return rss_kb / 1024
+
+# Клиент: настоящее рукопожатие (строка имени, строка комнаты), затем сообщения с временем отправки.
+# Задержка — разница между временем получения и временем отправки; часы монотонные и общие для процессов
+class LoadClient:
+    def __init__(self, username, room):
+        self.username = username
+        self.room = room
+        self.sent = 0
+        self.latencies = array("q")
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(f"{self.username}\n{self.room}\n".encode())
+        await self.writer.drain()
+
+    async def receive(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                received_at = time.monotonic_ns()
+                # Сообщение: "load|время отправки|заполнитель"
+                if line.startswith(MARKER):
+                    self.latencies.append(received_at - int(line.split(b"|", 2)[1]))
+        except ConnectionError:
+            pass
+
+    async def send(self, rate, stop_at, padding):
+        await asyncio.sleep(random.random() / rate)  # Клиенты отправляют не одновременно
+        while time.monotonic() < stop_at:
+            self.writer.write(MARKER + f"{time.monotonic_ns()}|{padding}\n".encode())
+            self.sent += 1
+            await self.writer.drain()
+            await asyncio.sleep(1 / rate)
+
+# Комнаты: rooms общих комнат, по которым клиенты распределяются по кругу, и private_pairs личных комнат на двоих
+def plan_clients(clients_count, rooms, private_pairs, process_index, processes_count):
+    plan = [(f"user{index}", f"room{index % rooms}") for index in range(clients_count)]
+    plan += [(f"pair{index}_{member}", f"private_pair{index}") for index in range(private_pairs) for member in (0, 1)]
+    return plan[process_index::processes_count]
+
+async def run_clients(host, port, plan, rate, duration, message_size, connect_batch, barrier):
+    load_clients = [LoadClient(username, room) for username, room in plan]
+    for start in range(0, len(load_clients), connect_batch):
+        await asyncio.gather(*(client.connect(host, port) for client in load_clients[start:start + connect_batch]))
+    receivers = [asyncio.create_task(client.receive()) for client in load_clients]
+
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    padding = "x" * max(message_size - len(MARKER) - 20, 0)
+    stop_at = time.monotonic() + duration
+    await asyncio.gather(*(client.send(rate, stop_at, padding) for client in load_clients))
+    await asyncio.sleep(1)  # Доставка сообщений, еще находящихся в пути
+
+    for client in load_clients:
+        client.writer.close()
+    await asyncio.gather(*receivers)
+
+    latencies = array("q")
+    sent_by_room = {}
+    for client in load_clients:
+        latencies.extend(client.latencies)
+        sent_by_room[client.room] = sent_by_room.get(client.room, 0) + client.sent
+    return {"sentByRoom": sent_by_room, "latencies": latencies.tobytes()}
+
+def load_process(host, port, plan, rate, duration, message_size, connect_batch, barrier, results):
+    raise_open_files_limit()
+    results.put(asyncio.run(run_clients(host, port, plan, rate, duration, message_size, connect_batch, barrier)))
+
+def percentile(sorted_values, share):
+    return sorted_values[min(int(len(sorted_values) * share), len(sorted_values) - 1)] if sorted_values else 0
+
+def run_load_test(arguments):
+    raise_open_files_limit()
+    server = None
+    host, port = arguments.host, arguments.port
+    if port is None:
+        # Сервер запускается отдельным процессом; журнал подключений тысяч клиентов не нужен
+        host, port = "127.0.0.1", free_port()
+        server = subprocess.Popen([sys.executable, SERVER_PATH, "--host", host, "--port", str(port),
+                                   "--workers", str(arguments.workers), "--loop", arguments.loop,
+                                   "--log-level", "WARNING"])
+        wait_for_server(port)
+        time.sleep(0.5)
+
+    try:
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(arguments.processes + 1)
+        results = context.Queue()
+        processes = [context.Process(target=load_process,
+                                     args=(host, port, plan_clients(arguments.clients, arguments.rooms, arguments.private_pairs,
+                                                                    index, arguments.processes),
+                                           arguments.rate, arguments.duration, arguments.message_size,
+                                           arguments.connect_batch, barrier, results))
+                     for index in range(arguments.processes)]
+        for process in processes:
+            process.start()
+
+        # Замер памяти сервера, пока клиенты отправляют сообщения
+        barrier.wait()
+        peak_rss = 0
+        stop_at = time.monotonic() + arguments.duration + 1
+        while server is not None and sys.platform.startswith("linux") and time.monotonic() < stop_at:
+            peak_rss = max(peak_rss, server_rss_mb(server.pid))
+            time.sleep(0.5)
+
+        process_results = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latencies = array("q")
+    sent_by_room = {}
+    for result in process_results:
+        latencies.frombytes(result["latencies"])
+        for room, sent in result["sentByRoom"].items():
+            sent_by_room[room] = sent_by_room.get(room, 0) + sent
+    latencies = sorted(latencies)
+
+    # Каждое сообщение получают все участники комнаты, включая отправителя
+    room_sizes = {}
+    for index in range(arguments.processes):
+        for _, room in plan_clients(arguments.clients, arguments.rooms, arguments.private_pairs, index, arguments.processes):
+            room_sizes[room] = room_sizes.get(room, 0) + 1
+    expected = sum(sent * room_sizes[room] for room, sent in sent_by_room.items())
+
+    return {
+        "clients": sum(room_sizes.values()),
+        "messagesPerSecond": sum(sent_by_room.values()) / arguments.duration,
+        "deliveriesPerSecond": len(latencies) / arguments.duration,
+        "delivered": len(latencies) / expected if expected else 1.0,
+        "p50LatencyMs": percentile(latencies, 0.5) / 1e6,
+        "p99LatencyMs": percentile(latencies, 0.99) / 1e6,
+        "maxLatencyMs": (latencies[-1] if latencies else 0) / 1e6,
+        "serverRssMB": peak_rss or None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сервера чата")
+    parser.add_argument("--host", default="127.0.0.1", help="адрес уже запущенного сервера (вместе с --port)")
+    parser.add_argument("--port", type=int, help="порт уже запущенного сервера; без него сервер запускается тестом")
+    parser.add_argument("--workers", type=int, default=1, help="воркеров запускаемого сервера")
+    parser.add_argument("--loop", choices=["asyncio", "uvloop"], default="asyncio", help="цикл событий запускаемого сервера")
+    parser.add_argument("--clients", type=int, default=2000, help="клиентов в общих комнатах")
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--private-pairs", dest="private_pairs", type=int, default=100, help="личных комнат на двоих")
+    parser.add_argument("--rate", type=float, default=0.5, help="сообщений в секунду от каждого клиента")
+    parser.add_argument("--duration", type=float, default=10, help="секунд отправки")
+    parser.add_argument("--message-size", dest="message_size", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=max(1, (os.cpu_count() or 1) // 2), help="процессов нагрузки")
+    parser.add_argument("--connect-batch", dest="connect_batch", type=int, default=200, help="одновременных подключений")
+    arguments = parser.parse_args()
+
+    result = run_load_test(arguments)
+    memory = f"{result['serverRssMB']:.0f} МБ" if result["serverRssMB"] else "н/д"
+    print(f"клиентов {result['clients']}: {result['messagesPerSecond']:.0f} сообщ/с, "
+          f"{result['deliveriesPerSecond']:.0f} доставок/с, доставлено {result['delivered']:.1%}, "
+          f"задержка p50 {result['p50LatencyMs']:.1f} мс, p99 {result['p99LatencyMs']:.1f} мс, "
+          f"макс. {result['maxLatencyMs']:.1f} мс, память сервера {memory}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import struct
+
+# Протокол кадров чата, общий для сервера и клиента.
+# Кадр: версия (1 байт), тип (1 байт), длина данных (4 байта, big-endian), данные в UTF-8.
+# Первый байт кадра (версия) не может начинать имя пользователя, поэтому сервер по первому байту
+# отличает клиентов с кадрами от старых клиентов, которые передают строки
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct(">BBI")
+MAX_FRAME_SIZE = 1 << 20
+
+# Типы кадров
+CHAT = 1      # Сообщение чата
+PRESENCE = 2  # Присутствие: "=" + имена через "\n" (полный список), "+имя" (вход), "-имя" (выход), "?" (запрос списка)
+SYSTEM = 3    # Служебное сообщение сервера
+ACK = 4       # Подтверждение: число принятых сервером сообщений чата от клиента (8 байт, big-endian)
+JOIN = 5      # Вход клиента: "имя\nкомната"
+
+ACK_COUNT = struct.Struct(">Q")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(frame_type, payload):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, len(payload)) + payload
+
+
+# Разбор потока на кадры. Кадры, целиком лежащие в полученном блоке, возвращаются как memoryview
+# без копирования. Кадр, разрезанный между блоками, собирается в pending: в него дописываются только
+# его недостающие байты, поэтому большой кадр, пришедший мелкими блоками, собирается за линейное время
+class FrameParser:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.pending = bytearray()
+
+    # Тип и длина данных кадра по заголовку с позиции offset
+    def read_header(self, buffer, offset):
+        version, frame_type, length = HEADER.unpack_from(buffer, offset)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Неподдерживаемая версия протокола: {version}")
+        if length > self.max_frame_size:
+            raise ProtocolError(f"Слишком большой кадр: {length} байт")
+        return frame_type, length
+
+    # Возвращает список (тип, данные) для всех полностью полученных кадров
+    def feed(self, data):
+        view = memoryview(data)
+        frames = []
+        offset = 0
+        if self.pending:
+            # Сначала дописывается заголовок, затем данные разрезанного кадра — не больше, чем ему нужно
+            offset = min(HEADER.size - len(self.pending), len(view)) if len(self.pending) < HEADER.size else 0
+            self.pending += view[:offset]
+            if len(self.pending) < HEADER.size:
+                return frames
+            frame_type, length = self.read_header(self.pending, 0)
+            taken = min(HEADER.size + length - len(self.pending), len(view) - offset)
+            self.pending += view[offset:offset + taken]
+            offset += taken
+            if len(self.pending) < HEADER.size + length:
+                return frames
+            # Собранный буфер отдаётся кадру целиком, для следующего разрезанного кадра заводится новый
+            frames.append((frame_type, memoryview(self.pending)[HEADER.size:]))
+            self.pending = bytearray()
+
+        while len(view) - offset >= HEADER.size:
+            frame_type, length = self.read_header(view, offset)
+            end = offset + HEADER.size + length
+            if end > len(view):
+                break
+            frames.append((frame_type, view[offset + HEADER.size:end]))
+            offset = end
+
+        if offset < len(view):
+            self.pending += view[offset:]
+        return frames
+
+
+def decode_text(payload):
+    return str(payload, "utf-8")
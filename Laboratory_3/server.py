@@ -1,74 +1,1132 @@
+import argparse
 import asyncio
+import hashlib
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import tempfile
+import time
+from collections import OrderedDict, deque
 
+import protocol
+
+# Размер очереди исходящих сообщений каждого клиента
+OUTBOUND_QUEUE_SIZE = 1000
+# Что делать с клиентом, который не успевает читать и у которого переполнилась очередь:
+# "drop" — новые сообщения для него отбрасываются,
+# "disconnect" — клиент отключается,
+# "coalesce" — устаревшие сообщения о состоянии (список активных пользователей) заменяются новыми,
+#              а при переполнении отбрасывается самое старое сообщение
+SLOW_CLIENT_POLICY = "drop"
+# Через сколько подряд прочитанных сообщений клиента уступать управление задачам отправки.
+# Пока накапливается пачка, сообщения уходят получателям одним вызовом writelines
+BROADCAST_BATCH = 64
+# Сколько ждать отправки оставшихся сообщений при отключении клиента
+CLOSE_FLUSH_TIMEOUT = 5
+# Присутствие: при входе новый участник получает полный список, остальные — только изменение.
+# Полный список можно запросить командой USERS_COMMAND; раз в PRESENCE_SNAPSHOT_INTERVAL секунд
+# он рассылается всем (0 — не рассылать)
+USERS_COMMAND = "/users"
+PRESENCE_SNAPSHOT_INTERVAL = 0
+
+# Размер блока чтения для клиентов с кадрами
+READ_CHUNK_SIZE = 1 << 16
+# Очередь ожидающих подключений: при одновременном подключении тысяч клиентов
+# стандартных 100 не хватает, и часть клиентов ждет повторной попытки соединения
+LISTEN_BACKLOG = 4096
+# Цикл событий: "asyncio" — стандартный, "uvloop" — uvloop (pip install uvloop; не работает в Windows)
+EVENT_LOOP = "asyncio"
+# Журнал сервера: записи уходят в очередь, а в stderr их пишет отдельный поток, поэтому цикл событий
+# не ждет вывода. Подключения пишутся на уровне INFO, каждое сообщение чата — на уровне DEBUG.
+# LOG_FORMAT: "text" — "поле=значение", "json" — одна запись JSON на строку
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "text"
+# Порт HTTP-метрик на 127.0.0.1 (None — не запускать); в режиме нескольких процессов воркер i слушает METRICS_PORT + i
+METRICS_PORT = None
+
+# История комнаты: последние сообщения чата, не больше HISTORY_MAX_MESSAGES и HISTORY_MAX_BYTES.
+# Новый участник получает ее одной записью при входе
+HISTORY_MAX_MESSAGES = 100
+HISTORY_MAX_BYTES = 64 * 1024
+# В памяти хранится история не более HISTORY_HOT_ROOMS комнат; история давно не используемых комнат
+# без участников вытесняется (на диск, если задан HISTORY_DIR, иначе теряется)
+HISTORY_HOT_ROOMS = 1000
+# Каталог журналов истории (None — история только в памяти). Журнал комнаты — файл кадров чата,
+# дописываемый раз в HISTORY_FLUSH_INTERVAL секунд и сжимаемый до содержимого истории,
+# когда вырастает больше HISTORY_COMPACT_BYTES
+HISTORY_DIR = None
+HISTORY_FLUSH_INTERVAL = 1
+HISTORY_COMPACT_BYTES = 4 * HISTORY_MAX_BYTES
+
+# Комнаты: {комната: {writer: ClientConnection}} — вход и выход за O(1)
 clients = {}
 
+logger = logging.getLogger("chat")
+
+# Счетчики с запуска процесса; текущие значения (подключения, очереди) собираются при запросе метрик
+metrics = {
+    "connections": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+    "messages_in": 0,
+    "dropped": 0,
+    "slow_disconnects": 0,
+    "fanouts": 0,
+    "fanout_seconds": 0.0,
+    "fanout_seconds_max": 0.0
+}
+
+# Режим нескольких процессов: каждый воркер принимает подключения на общем порту (SO_REUSEPORT),
+# а сообщения комнат, участники которых подключены к разным воркерам, передаются через шину —
+# Unix-сокет родительского процесса. Кадры шины используют формат protocol.py, поля разделены "\n"
+BUS_JOIN = 16     # "комната\nимя": участник вошел в комнату на воркере
+BUS_LEAVE = 17    # "комната\nимя": участник вышел
+BUS_ROSTER = 18   # "комната\nимя\nимя...": участники других воркеров, когда у воркера появляется комната
+BUS_MESSAGE = 19  # "комната\nтип кадра\nтекст": сообщение для участников на других воркерах
+BUS_PRIVATE = 20  # "комната\nчисло": сколько участников личной комнаты на других воркерах (рассылается всем воркерам)
+# История комнаты есть у каждого воркера с ее участниками; один из них — хранитель — пишет журнал комнаты
+# и отдает историю воркеру, у которого комната появляется. Хранитель без участников помнит историю до передачи
+BUS_HISTORY_REQUEST = 21  # "комната": запрос истории у хранителя
+BUS_HISTORY = 22          # "комната\nкадры чата": история от хранителя; "комната" — хранителя нет, история читается
+                          # из журнала (или остается своя, если воркер сам последний хранитель)
+BUS_KEEPER = 23           # "комната": воркер становится хранителем и переписывает журнал из своей истории
+
+# Соединение воркера с шиной (None — сервер работает в одном процессе)
+bus_writer = None
+# Подключения воркера, о входе которых сообщено шине: {комната: число}
+room_members = {}
+# Участники комнат на других воркерах: {комната: {имя: число подключений}}
+remote_users = {}
+# Участники личных комнат на других воркерах: {комната: число}
+private_remote_sizes = {}
+# Запросы истории: {комната: deque(HistoryRequest)}. Шина отвечает на каждый первый вход на воркер по порядку
+history_requests = {}
+
+# Исходящее сообщение в двух видах: кадр заданного типа для клиентов с кадрами и строка text
+# для старых клиентов. Каждый вид кодируется не более одного раза и общий для всех получателей
+class OutgoingMessage:
+    __slots__ = ("frame_type", "payload", "text", "frame", "line")
+
+    def __init__(self, frame_type, payload, text=None):
+        self.frame_type = frame_type
+        self.payload = payload
+        self.text = payload if text is None else text
+        self.frame = self.line = None
+
+    def encode(self, framed):
+        if framed:
+            if self.frame is None:
+                self.frame = protocol.encode_frame(self.frame_type, self.payload)
+            return self.frame
+        if self.line is None:
+            self.line = f"{self.text}\n".encode()
+        return self.line
+
+# Подключение клиента: собственная ограниченная очередь исходящих сообщений и задача, которая ее отправляет.
+# Рассылка только кладет сообщения в очереди и не ждет медленных клиентов.
+# В очередь кладутся уже закодированные сообщения: один и тот же объект bytes общий для всех получателей
+class ClientConnection:
+    def __init__(self, username, writer, framed=False, queue_size=None, policy=None, connection_id=None):
+        self.username = username
+        self.connection_id = connection_id
+        self.writer = writer
+        self.framed = framed
+        self.queue_size = queue_size or OUTBOUND_QUEUE_SIZE
+        self.policy = policy or SLOW_CLIENT_POLICY
+        self.queue = deque()  # Элементы: (закодированное сообщение, ключ для замены или None)
+        self.has_messages = asyncio.Event()
+        self.dropped = 0
+        self.closed = False
+        self.writer_task = asyncio.create_task(self.write_messages())
+
+    # Несколько сообщений одной записью в очереди: они не вытесняют друг друга и уходят одним блоком
+    def send_batch(self, messages):
+        if self.closed or not messages:
+            return
+        self.queue.append((b"".join(message.encode(self.framed) for message in messages), None))
+        self.has_messages.set()
+
+    def send(self, message, coalesce_key=None):
+        if self.closed:
+            return
+        data = message.encode(self.framed)
+
+        if self.policy == "coalesce" and coalesce_key is not None:
+            for index, (_, queued_key) in enumerate(self.queue):
+                if queued_key == coalesce_key:
+                    del self.queue[index]
+                    self.dropped += 1
+                    metrics["dropped"] += 1
+                    break
+
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            metrics["dropped"] += 1
+            if self.policy == "disconnect":
+                self.abort()
+                return
+            if self.policy == "coalesce":
+                self.queue.popleft()
+            else:
+                return
+
+        self.queue.append((data, coalesce_key))
+        self.has_messages.set()
+
+    async def write_messages(self):
+        try:
+            while True:
+                await self.has_messages.wait()
+                # Все накопившиеся сообщения уходят одним вызовом writelines
+                batch = [self.queue.popleft()[0] for _ in range(len(self.queue))]
+                self.writer.writelines(batch)
+                metrics["bytes_out"] += sum(map(len, batch))
+                self.has_messages.clear()
+                await self.writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    # Медленный клиент отключается сразу, без отправки накопленных сообщений
+    def abort(self):
+        metrics["slow_disconnects"] += 1
+        log_event(logging.WARNING, "Медленный клиент отключен", user=self.username, queue=len(self.queue))
+        self.closed = True
+        self.queue.clear()
+        self.writer_task.cancel()
+        self.writer.transport.abort()
+
+    # Обычное отключение: оставшиеся сообщения отправляются, но не дольше CLOSE_FLUSH_TIMEOUT
+    async def close(self):
+        self.closed = True
+        self.writer_task.cancel()
+        try:
+            if not self.writer.is_closing():
+                batch = [self.queue.popleft()[0] for _ in range(len(self.queue))]
+                self.writer.writelines(batch)
+                metrics["bytes_out"] += sum(map(len, batch))
+                await asyncio.wait_for(self.writer.drain(), CLOSE_FLUSH_TIMEOUT)
+            self.writer.close()
+            await self.writer.wait_closed()
+        except (ConnectionError, asyncio.TimeoutError, asyncio.CancelledError):
+            self.writer.transport.abort()
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, as_json=False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = {"time": self.formatTime(record), "level": record.levelname, "message": record.getMessage()}
+        fields.update(getattr(record, "fields", {}))
+        if self.as_json:
+            return json.dumps(fields, ensure_ascii=False, default=str)
+        return " ".join([fields.pop("time"), fields.pop("level"), fields.pop("message")] +
+                        [f"{name}={value}" for name, value in fields.items()])
+
+
+# Возвращает поток записи журнала; его нужно остановить при завершении, чтобы записать оставшиеся записи
+def configure_logging():
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter(LOG_FORMAT == "json"))
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(LOG_LEVEL.upper())
+    logger.propagate = False
+    log_listener.start()
+    return log_listener
+
+
+# Запись журнала с полями; на отключенном уровне поля не собираются и запись не создается
+def log_event(level, message, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={"fields": fields})
+
+
 async def handle_client(reader, writer):
     addr = writer.get_extra_info('peername')
-    print(f"Новое подключение: {addr}")
+    metrics["connections"] += 1
+    connection_id = metrics["connections"]
+    log_event(logging.DEBUG, "Новое подключение", addr=addr)
 
+    username = room = connection = None
     try:
-        username = (await reader.readline()).decode().strip()
-        room = (await reader.readline()).decode().strip()
+        # Клиент с кадрами начинает с байта версии протокола, старый клиент — сразу с имени пользователя
+        first_byte = await reader.read(1)
+        if not first_byte:
+            return
+        framed = first_byte[0] == protocol.PROTOCOL_VERSION
+        if framed:
+            parser = protocol.FrameParser()
+            username, room, frames = await read_join(reader, parser, first_byte)
+        else:
+            username = (first_byte + await reader.readline()).decode().strip()
+            room = (await reader.readline()).decode().strip()
 
         # Если это личный чат, убедимся, что в комнате только два человека
         if room.startswith("private_"):
-            if room in clients and len(clients[room]) > 1:
-                writer.write("Комната уже занята.\n".encode())
+            if room_members.get(room, 0) + private_remote_sizes.get(room, 0) > 1:
+                writer.write(OutgoingMessage(protocol.SYSTEM, "Комната уже занята.").encode(framed))
                 await writer.drain()
                 writer.close()
                 await writer.wait_closed()
                 return
-        
-        if room not in clients:
-            clients[room] = []
-        clients[room].append((username, writer))
-        print(f"Клиент {username}{addr} подключился в комнату {room}")
 
-        await send_active_users_to_room(room)
+        connection = ClientConnection(username, writer, framed, connection_id=connection_id)
+        join_room(room, username)
+        log_event(logging.INFO, "Клиент вошел в комнату", user=username, addr=addr, room=room)
+
+        # Пока воркер ждет историю комнаты, участник не получает сообщения: история и сообщения после нее
+        # отправляются ему вместе, без повторов
+        if room in history_requests:
+            await asyncio.shield(history_requests[room][-1].ready)
+        connection.send_batch([message for message, _ in get_history(room).messages])
+        clients.setdefault(room, {})[writer] = connection
+        send_active_users(room, connection)
+        send_presence_to_room(room, True, username, exclude=connection)
+
+        send_message_to_room(room, f"{username} присоединился к комнате.", protocol.SYSTEM)
+
+        if framed:
+            await read_frames(reader, parser, frames, room, connection, addr)
+        else:
+            await read_lines(reader, room, connection, addr)
+
+    except (ConnectionError, protocol.ProtocolError, UnicodeDecodeError, asyncio.CancelledError):
+        pass
+    finally:
+        if connection is not None:
+            # Удаление клиента и рассылка изменения списка активных пользователей
+            room_clients = clients.get(room)
+            if room_clients is not None:
+                room_clients.pop(writer, None)
+                if room_clients:
+                    send_presence_to_room(room, False, username)
+                else:
+                    del clients[room]
+            await leave_room(room, username)
+
+            log_event(logging.INFO, "Клиент вышел из комнаты", user=username, addr=addr, room=room)
+            send_message_to_room(room, f"{username} покинул комнату.", protocol.SYSTEM)
+            if room not in room_members:
+                remote_users.pop(room, None)
+
+            await connection.close()
+        else:
+            writer.close()
+
+
+# Первый участник комнаты на воркере запрашивает ее историю, остальные ждут того же ответа
+def join_room(room, username):
+    if bus_writer is not None and room not in room_members:
+        history_requests.setdefault(room, deque()).append(HistoryRequest())
+    room_members[room] = room_members.get(room, 0) + 1
+    publish_to_bus(BUS_JOIN, room, username)
+
+
+# Хранитель журнала, у которого выходит последний участник комнаты, дописывает журнал (дождавшись начатой записи)
+# до выхода из шины: следующий воркер с этой комнатой прочитает полный журнал
+async def leave_room(room, username):
+    while bus_writer is not None and HISTORY_DIR is not None and room_members[room] == 1:
+        history = room_histories.get(room)
+        if history is None or not history.kept:
+            break
+        try:
+            await write_histories([history])
+        except asyncio.CancelledError:
+            break  # Остановка сервера: оставшиеся кадры запишет flush_all_histories
+        if not history.pending and not history.rewrite:
+            break
+
+    if room_members[room] > 1:
+        room_members[room] -= 1
+    else:
+        del room_members[room]
+        history = room_histories.get(room)
+        if bus_writer is not None and history is not None:
+            history.kept = False
+    publish_to_bus(BUS_LEAVE, room, username)
+
+
+# Ожидает кадр входа "имя\nкомната"; кадры, пришедшие вместе с ним, возвращаются для обработки
+async def read_join(reader, parser, data):
+    frames = parser.feed(data)
+    while not frames:
+        data = await reader.read(READ_CHUNK_SIZE)
+        if not data:
+            raise ConnectionError("Клиент отключился до входа в комнату")
+        frames = parser.feed(data)
+
+    frame_type, payload = frames[0]
+    if frame_type != protocol.JOIN:
+        raise protocol.ProtocolError(f"Ожидался кадр входа, получен кадр типа {frame_type}")
+    username, _, room = protocol.decode_text(payload).partition("\n")
+    return username.strip(), room.strip(), frames[1:]
+
+
+# Старые клиенты: одно сообщение на строку
+async def read_lines(reader, room, connection, addr):
+    messages_count = 0
+    while True:
+        data = await reader.readline()
+        if not data:
+            break
+        metrics["bytes_in"] += len(data)
+        message = data.decode().strip()
+        if message == USERS_COMMAND:
+            send_active_users(room, connection)
+            continue
+        metrics["messages_in"] += 1
+        log_event(logging.DEBUG, "Сообщение", user=connection.username, addr=addr, room=room, text=message)
+        send_message_to_room(room, message)
+        # readline не уступает управление, пока в буфере есть строки; без этого при потоке сообщений
+        # от одного клиента задачи отправки не успевали бы разгружать очереди остальных
+        messages_count += 1
+        if messages_count % BROADCAST_BATCH == 0:
+            await asyncio.sleep(0)
+
+
+# Клиенты с кадрами: данные читаются блоками, кадры разбираются без копирования.
+# После каждого блока клиенту отправляется одно подтверждение с числом принятых сообщений
+async def read_frames(reader, parser, frames, room, connection, addr):
+    messages_count = 0
+    while True:
+        acknowledged = messages_count
+        for frame_type, payload in frames:
+            if frame_type == protocol.CHAT:
+                message = protocol.decode_text(payload)
+                metrics["messages_in"] += 1
+                log_event(logging.DEBUG, "Сообщение", user=connection.username, addr=addr, room=room, text=message)
+                send_message_to_room(room, message)
+                messages_count += 1
+                if messages_count % BROADCAST_BATCH == 0:
+                    await asyncio.sleep(0)
+            elif frame_type == protocol.PRESENCE and payload == b"?":
+                send_active_users(room, connection)
+        if messages_count != acknowledged:
+            connection.send(OutgoingMessage(protocol.ACK, protocol.ACK_COUNT.pack(messages_count)))
+
+        data = await reader.read(READ_CHUNK_SIZE)
+        if not data:
+            break
+        metrics["bytes_in"] += len(data)
+        frames = parser.feed(data)
+
+
+def active_users_message(room):
+    active_users = [client.username for client in clients[room].values()]
+    active_users += [name for name, count in remote_users.get(room, {}).items() for _ in range(count)]
+    return OutgoingMessage(protocol.PRESENCE, "=" + "\n".join(active_users),
+                           f"Активные пользователи в комнате {room}: {', '.join(active_users)}")
+
+
+# Полный список активных пользователей одному клиенту
+def send_active_users(room, connection):
+    if room in clients:
+        connection.send(active_users_message(room), coalesce_key="active_users")
+
+
+# Полный список всем участникам комнаты (периодическая сверка)
+def send_active_users_to_room(room):
+    if room in clients:
+        message = active_users_message(room)
+        for client in clients[room].values():
+            client.send(message, coalesce_key="active_users")
+
+
+# Изменение списка активных пользователей: кадр "+имя" или "-имя",
+# для старых клиентов строка "Пользователь вошел в комнату ...: имя" или "вышел из комнаты"
+def send_presence_to_room(room, joined, username, exclude=None):
+    if room in clients:
+        action = "вошел в комнату" if joined else "вышел из комнаты"
+        message = OutgoingMessage(protocol.PRESENCE, ("+" if joined else "-") + username,
+                                  f"Пользователь {action} {room}: {username}")
+        for client in clients[room].values():
+            if client is not exclude:
+                client.send(message)
+
+
+async def send_presence_snapshots():
+    while True:
+        await asyncio.sleep(PRESENCE_SNAPSHOT_INTERVAL)
+        for room in list(clients):
+            send_active_users_to_room(room)
+
+
+# Сообщение кодируется один раз для каждого вида протокола, получатели разделяют один объект bytes.
+# Если в комнате есть участники на других воркерах, сообщение уходит и в шину. Служебные сообщения
+# уходят в шину всегда: при первом входе на воркер состав комнаты на других воркерах еще неизвестен
+def send_message_to_room(room, message, frame_type=protocol.CHAT):
+    deliver_to_room(room, OutgoingMessage(frame_type, message))
+    if remote_users.get(room) or frame_type == protocol.SYSTEM:
+        publish_to_bus(BUS_MESSAGE, room, str(frame_type), message)
+
+
+def deliver_to_room(room, message):
+    if message.frame_type == protocol.CHAT:
+        get_history(room).append(message)
+    if room in clients:
+        started = time.perf_counter()
+        for client in clients[room].values():
+            client.send(message)
+        elapsed = time.perf_counter() - started
+        metrics["fanouts"] += 1
+        metrics["fanout_seconds"] += elapsed
+        metrics["fanout_seconds_max"] = max(metrics["fanout_seconds_max"], elapsed)
+
+
+class RoomHistory:
+    def __init__(self, room):
+        self.room = room
+        self.messages = deque()  # Элементы: (OutgoingMessage, размер в байтах)
+        self.size = 0
+        self.pending = []  # Кадры, еще не записанные в журнал
+        self.log_size = 0
+        self.kept = bus_writer is None  # Пишет ли процесс журнал комнаты (в режиме воркеров — только хранитель)
+        self.rewrite = False
+
+    def append(self, message):
+        self.keep(message)
+        if HISTORY_DIR is not None and self.kept:
+            self.pending.append(message.encode(True))
+            dirty_histories.add(self)
+
+    # Воркер стал хранителем: журнал переписывается из истории, в которой есть сообщения, не записанные прежним
+    def start_keeping(self):
+        self.kept = True
+        if HISTORY_DIR is not None:
+            self.rewrite = True
+            dirty_histories.add(self)
+
+    # Добавляет сообщение в кольцевой буфер, вытесняя самые старые сверх ограничений
+    def keep(self, message):
+        size = len(message.encode(False))
+        self.messages.append((message, size))
+        self.size += size
+        while len(self.messages) > HISTORY_MAX_MESSAGES or self.size > HISTORY_MAX_BYTES:
+            self.size -= self.messages.popleft()[1]
+
+
+# История комнат в порядке последнего использования
+room_histories = OrderedDict()
+dirty_histories = set()
+
+
+def history_path(room):
+    return os.path.join(HISTORY_DIR, hashlib.sha1(room.encode()).hexdigest() + ".log")
+
+
+def get_history(room):
+    history = room_histories.get(room)
+    if history is not None:
+        room_histories.move_to_end(room)
+        return history
+
+    history = room_histories[room] = load_history(room)
+    if len(room_histories) > HISTORY_HOT_ROOMS:
+        evict_histories()
+    return history
+
+
+def load_history(room):
+    history = RoomHistory(room)
+    if HISTORY_DIR is None:
+        return history
+    try:
+        with open(history_path(room), "rb") as log_file:
+            data = log_file.read()
+    except FileNotFoundError:
+        return history
+
+    # Журнал — те же кадры, что получают клиенты; недописанный последний кадр пропускается
+    for frame_type, payload in protocol.FrameParser().feed(data):
+        history.keep(OutgoingMessage(frame_type, protocol.decode_text(payload)))
+    history.log_size = len(data)
+    if history.kept and history.log_size > HISTORY_COMPACT_BYTES:
+        dirty_histories.add(history)
+    return history
+
+
+# Вытесняет самые давно использованные комнаты без участников; несохраненные кадры дописываются сразу
+def evict_histories():
+    for room in list(room_histories):
+        if len(room_histories) <= HISTORY_HOT_ROOMS:
+            break
+        if room in room_members or room in clients:
+            continue
+        history = room_histories.pop(room)
+        if history in dirty_histories:
+            dirty_histories.discard(history)
+            write_history_logs([history_write(history)])
+
+
+# Что записать в журнал комнаты: (путь, данные, заменить ли файл целиком)
+def history_write(history):
+    data = b"".join(history.pending)
+    history.pending = []
+    history.log_size += len(data)
+    if not history.rewrite and history.log_size <= HISTORY_COMPACT_BYTES:
+        return history_path(history.room), data, False
+
+    history.rewrite = False
+    data = b"".join(message.encode(True) for message, _ in history.messages)
+    history.log_size = len(data)
+    return history_path(history.room), data, True
 
-        await send_message_to_room(room, f"{username} присоединился к комнате.")
 
+def write_history_logs(writes):
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    for path, data, compact in writes:
+        if compact:
+            # Сжатие: новый файл подменяет журнал атомарно
+            with open(path + ".tmp", "wb") as log_file:
+                log_file.write(data)
+            os.replace(path + ".tmp", path)
+        elif data:
+            with open(path, "ab") as log_file:
+                log_file.write(data)
+
+
+def flush_all_histories():
+    writes = [history_write(history) for history in dirty_histories]
+    dirty_histories.clear()
+    write_history_logs(writes)
+
+
+# Запись журналов вне цикла событий: данные собираются в цикле, файлы пишет отдельный поток.
+# Записи идут по одной, чтобы кадры попадали в журнал в порядке сообщений
+history_write_lock = asyncio.Lock()
+
+
+async def write_histories(histories):
+    async with history_write_lock:
+        writes = [history_write(history) for history in histories]
+        await asyncio.to_thread(write_history_logs, writes)
+
+
+async def flush_histories():
+    while True:
+        await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+        if dirty_histories:
+            histories = list(dirty_histories)
+            dirty_histories.clear()
+            await write_histories(histories)
+
+
+def metric_labels(**labels):
+    escaped = (name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for name, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+# Метрики в текстовом формате Prometheus
+def metrics_text():
+    lines = [
+        "# TYPE chat_connections_total counter",
+        f"chat_connections_total {metrics['connections']}",
+        "# TYPE chat_bytes_in_total counter",
+        f"chat_bytes_in_total {metrics['bytes_in']}",
+        "# TYPE chat_bytes_out_total counter",
+        f"chat_bytes_out_total {metrics['bytes_out']}",
+        "# TYPE chat_messages_in_total counter",
+        f"chat_messages_in_total {metrics['messages_in']}",
+        "# TYPE chat_dropped_messages_total counter",
+        f"chat_dropped_messages_total {metrics['dropped']}",
+        "# TYPE chat_slow_client_disconnects_total counter",
+        f"chat_slow_client_disconnects_total {metrics['slow_disconnects']}",
+        "# TYPE chat_fanout_seconds summary",
+        f"chat_fanout_seconds_sum {metrics['fanout_seconds']:.9f}",
+        f"chat_fanout_seconds_count {metrics['fanouts']}",
+        "# TYPE chat_fanout_seconds_max gauge",
+        f"chat_fanout_seconds_max {metrics['fanout_seconds_max']:.9f}",
+        "# TYPE chat_history_rooms gauge",
+        f"chat_history_rooms {len(room_histories)}",
+        "# TYPE chat_room_connections gauge"
+    ]
+    lines += [f"chat_room_connections{metric_labels(room=room)} {len(room_clients)}" for room, room_clients in clients.items()]
+    # У одного пользователя может быть несколько подключений в комнате, поэтому ряды клиентов
+    # различаются номером подключения
+    client_labels = [(metric_labels(room=room, user=client.username, connection=client.connection_id), client)
+                     for room, room_clients in clients.items() for client in room_clients.values()]
+    lines.append("# TYPE chat_client_queue_depth gauge")
+    lines += [f"chat_client_queue_depth{labels} {len(client.queue)}" for labels, client in client_labels]
+    lines.append("# TYPE chat_client_dropped_messages gauge")
+    lines += [f"chat_client_dropped_messages{labels} {client.dropped}" for labels, client in client_labels]
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        request = request_line.split()
+        if len(request) > 1 and request[0] == b"GET" and request[1] == b"/metrics":
+            status, body = "200 OK", metrics_text().encode()
+        else:
+            status, body = "404 Not Found", b"GET /metrics\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server():
+    if METRICS_PORT is None:
+        return None
+    metrics_server = await asyncio.start_server(handle_metrics_request, "127.0.0.1", METRICS_PORT)
+    log_event(logging.INFO, "Метрики доступны", url=f"http://127.0.0.1:{METRICS_PORT}/metrics")
+    return metrics_server
+
+
+def encode_bus_frame(frame_type, *fields):
+    return protocol.encode_frame(frame_type, "\n".join(fields))
+
+
+# Запись в шину не ждет drain: шина локальная, и воркеры разбирают ее без задержек
+def publish_to_bus(frame_type, *fields):
+    if bus_writer is not None:
+        bus_writer.write(encode_bus_frame(frame_type, *fields))
+
+
+def add_remote_user(room, username, count=1):
+    users = remote_users.setdefault(room, {})
+    users[username] = users.get(username, 0) + count
+
+
+def remove_remote_user(room, username):
+    users = remote_users.get(room, {})
+    if users.get(username, 0) > 1:
+        users[username] -= 1
+    else:
+        users.pop(username, None)
+
+
+# Воркер: применяет кадры шины к локальным участникам комнат
+async def read_bus(reader):
+    parser = protocol.FrameParser()
+    messages_count = 0
+    while True:
+        try:
+            data = await reader.read(READ_CHUNK_SIZE)
+        except ConnectionError:
+            break
+        if not data:
+            break
+        for frame_type, payload in parser.feed(data):
+            if frame_type == BUS_HISTORY:
+                receive_history(bytes(payload))
+                continue
+            room, _, fields = protocol.decode_text(payload).partition("\n")
+            if frame_type == BUS_PRIVATE:
+                if fields == "0":
+                    private_remote_sizes.pop(room, None)
+                else:
+                    private_remote_sizes[room] = int(fields)
+                continue
+            if frame_type == BUS_HISTORY_REQUEST:
+                send_history(room)
+                continue
+            if frame_type == BUS_KEEPER:
+                get_history(room).start_keeping()
+                continue
+            # Кадры для комнат, из которых уже вышли все локальные участники, устарели
+            if room not in room_members:
+                continue
+
+            if frame_type == BUS_MESSAGE:
+                message_type, _, message = fields.partition("\n")
+                message = OutgoingMessage(int(message_type), message)
+                requests = history_requests.get(room)
+                if requests:
+                    requests[-1].messages.append(message)
+                else:
+                    deliver_to_room(room, message)
+                messages_count += 1
+                if messages_count % BROADCAST_BATCH == 0:
+                    await asyncio.sleep(0)
+            elif frame_type == BUS_JOIN:
+                add_remote_user(room, fields)
+                send_presence_to_room(room, True, fields)
+            elif frame_type == BUS_LEAVE:
+                remove_remote_user(room, fields)
+                send_presence_to_room(room, False, fields)
+            elif frame_type == BUS_ROSTER:
+                remote_users[room] = {}
+                for username in fields.split("\n"):
+                    add_remote_user(room, username)
+                send_active_users_to_room(room)
+
+
+# Запрос истории комнаты: участники ждут ready, а сообщения шины, пришедшие до ответа, копятся в messages
+# и добавляются после полученной истории
+class HistoryRequest:
+    __slots__ = ("ready", "messages")
+
+    def __init__(self):
+        self.ready = asyncio.get_running_loop().create_future()
+        self.messages = []
+
+
+# Хранитель: история комнаты (из памяти или журнала) уходит в шину теми же кадрами, что получают клиенты
+def send_history(room):
+    frames = b"".join(message.encode(True) for message, _ in get_history(room).messages)
+    bus_writer.write(protocol.encode_frame(BUS_HISTORY, room.encode() + b"\n" + frames))
+
+
+def receive_history(payload):
+    room, separator, frames = payload.partition(b"\n")
+    room = room.decode()
+    requests = history_requests.get(room)
+    if not requests:
+        return
+    request = requests.popleft()
+    if not requests:
+        del history_requests[room]
+
+    if room in room_members:
+        if separator:
+            history = room_histories[room] = RoomHistory(room)
+            room_histories.move_to_end(room)
+            for frame_type, message in protocol.FrameParser().feed(frames):
+                history.keep(OutgoingMessage(frame_type, protocol.decode_text(message)))
+            if len(room_histories) > HISTORY_HOT_ROOMS:
+                evict_histories()
+        elif HISTORY_DIR is not None:
+            # Своя история могла устареть, пока комната была на других воркерах; журнал полный
+            dirty_histories.discard(room_histories.pop(room, None))
+        for message in request.messages:
+            deliver_to_room(room, message)
+    request.ready.set_result(None)
+
+
+# Шина: {комната: {writer воркера: {имя: число подключений}}}
+bus_rooms = {}
+bus_workers = set()
+# Хранители журналов: {комната: writer воркера}; для комнат без участников помнятся не более HISTORY_HOT_ROOMS
+bus_keepers = OrderedDict()
+# Воркеры, ждущие историю: {комната: [(writer воркера, writer хранителя)]}
+history_waits = {}
+
+
+# Шина в родительском процессе: ведет состав комнат по воркерам и пересылает кадры
+# только тем воркерам, у которых есть участники этой комнаты
+async def handle_bus_worker(reader, writer):
+    parser = protocol.FrameParser()
+    bus_workers.add(writer)
+    try:
         while True:
-            data = await reader.readline()
+            data = await reader.read(READ_CHUNK_SIZE)
             if not data:
                 break
-            message = data.decode().strip()
-            print(f"{username} ({addr}) в комнате {room}: {message}")
-            await send_message_to_room(room, message)
+            for frame_type, payload in parser.feed(data):
+                route_bus_frame(writer, frame_type, bytes(payload))
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        # Участники отключившегося воркера выходят из всех комнат
+        bus_workers.discard(writer)
+        for room in [room for room, workers in bus_rooms.items() if writer in workers]:
+            for username, count in bus_rooms[room].pop(writer).items():
+                for _ in range(count):
+                    forward_bus_frame(room, writer, encode_bus_frame(BUS_LEAVE, room, username))
+            if not bus_rooms[room]:
+                del bus_rooms[room]
+            if room.startswith("private_"):
+                send_private_room_sizes(room)
+        # Воркеры, ждавшие историю от отключившегося, читают журнал; хранение переходит к другим воркерам
+        for room, waits in list(history_waits.items()):
+            for waiting, keeper in waits:
+                if keeper is writer:
+                    waiting.write(encode_bus_frame(BUS_HISTORY, room))
+            waits[:] = [(waiting, keeper) for waiting, keeper in waits if writer not in (waiting, keeper)]
+            if not waits:
+                del history_waits[room]
+        for room in [room for room, keeper in bus_keepers.items() if keeper is writer]:
+            del bus_keepers[room]
+            replace_keeper(room)
+        writer.close()
 
+
+def route_bus_frame(worker, frame_type, payload):
+    room, _, fields = payload.partition(b"\n")
+    room = room.decode()
+    if frame_type == BUS_HISTORY:
+        forward_history(room, worker, payload)
+        return
+
+    first_join = room_left = False
+    skipped = ()
+    if frame_type == BUS_JOIN:
+        workers = bus_rooms.setdefault(room, {})
+        first_join = worker not in workers
+        if first_join:
+            roster = [username for users in workers.values() for username, count in users.items() for _ in range(count)]
+            if roster:
+                worker.write(encode_bus_frame(BUS_ROSTER, room, *roster))
+            workers[worker] = {}
+        users = workers[worker]
+        username = fields.decode()
+        users[username] = users.get(username, 0) + 1
+    elif frame_type == BUS_LEAVE:
+        users = bus_rooms.get(room, {}).get(worker, {})
+        username = fields.decode()
+        if users.get(username, 0) > 1:
+            users[username] -= 1
+        elif username in users:
+            del users[username]
+            if not users:
+                room_left = True
+                del bus_rooms[room][worker]
+                if not bus_rooms[room]:
+                    del bus_rooms[room]
+    elif frame_type == BUS_MESSAGE and room in history_waits and fields.startswith(b"%d\n" % protocol.CHAT):
+        # Сообщения чата, отправленные хранителем до ответа на запрос, уже есть в истории, которую ждет воркер
+        skipped = [waiting for waiting, keeper in history_waits[room] if keeper is worker]
+
+    # Кадр пересылается в неизменном виде, закодированный один раз
+    forward_bus_frame(room, worker, protocol.encode_frame(frame_type, payload), skipped)
+    # Запрос истории идет хранителю после кадра входа: сообщения, отправленные после ответа, хранитель
+    # рассылает и новому воркеру
+    if first_join:
+        request_history(room, worker)
+    if room_left and bus_keepers.get(room) is worker:
+        replace_keeper(room)
+    if frame_type in (BUS_JOIN, BUS_LEAVE) and room.startswith("private_"):
+        send_private_room_sizes(room)
+
+
+# Первый участник комнаты на воркере: историю отдает хранитель. Если хранителя нет или это сам воркер,
+# воркер берет историю из журнала или своей памяти и становится хранителем
+def request_history(room, worker):
+    keeper = bus_keepers.get(room)
+    if keeper is None or keeper is worker:
+        worker.write(encode_bus_frame(BUS_HISTORY, room))
+        set_keeper(room, worker)
+    else:
+        history_waits.setdefault(room, []).append((worker, keeper))
+        keeper.write(encode_bus_frame(BUS_HISTORY_REQUEST, room))
+
+
+def forward_history(room, keeper, payload):
+    waits = history_waits.get(room, [])
+    for index, (waiting, waits_keeper) in enumerate(waits):
+        if waits_keeper is keeper:
+            del waits[index]
+            break
+    else:
+        return
+    if not waits:
+        del history_waits[room]
+    waiting.write(protocol.encode_frame(BUS_HISTORY, payload))
+    # Хранитель без участников комнаты передает хранение воркеру, получившему историю
+    workers = bus_rooms.get(room, ())
+    if bus_keepers.get(room) is keeper and keeper not in workers and waiting in workers:
+        set_keeper(room, waiting)
+
+
+def set_keeper(room, worker):
+    bus_keepers[room] = worker
+    worker.write(encode_bus_frame(BUS_KEEPER, room))
+
+
+# Хранитель вышел из комнаты: хранение переходит к воркеру с участниками комнаты, у которого уже есть история.
+# Если такого нет, хранитель остается и отдает историю из памяти или журнала; хранители комнат
+# без участников забываются, начиная с самых давних
+def replace_keeper(room):
+    waiting = {waiting for waiting, _ in history_waits.get(room, ())}
+    for worker in bus_rooms.get(room, ()):
+        if worker not in waiting:
+            set_keeper(room, worker)
+            return
+
+    if room in bus_keepers:
+        bus_keepers.move_to_end(room)
+    for idle_room in list(bus_keepers):
+        if len(bus_keepers) <= len(bus_rooms) + HISTORY_HOT_ROOMS:
+            break
+        if idle_room not in bus_rooms and idle_room not in history_waits:
+            del bus_keepers[idle_room]
+
+
+# Ограничение личной комнаты проверяет воркер, к которому подключился клиент, поэтому
+# каждый воркер знает, сколько участников личной комнаты подключено к остальным
+def send_private_room_sizes(room):
+    sizes = {worker: sum(users.values()) for worker, users in bus_rooms.get(room, {}).items()}
+    total = sum(sizes.values())
+    for worker in bus_workers:
+        worker.write(encode_bus_frame(BUS_PRIVATE, room, str(total - sizes.get(worker, 0))))
+
+
+def forward_bus_frame(room, sender, frame, skipped=()):
+    for worker in bus_rooms.get(room, ()):
+        if worker is not sender and worker not in skipped:
+            worker.write(frame)
+
+
+# Слушающий сокет на общем порту: ядро распределяет подключения между воркерами
+def reuse_port_socket(host, port):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((host, port))
+    return server_socket
+
+
+async def run_worker(host, port, bus_path):
+    global bus_writer
+    stop_on_sigterm()
+    bus_reader, bus_writer = await asyncio.open_unix_connection(bus_path)
+    server = await asyncio.start_server(handle_client, sock=reuse_port_socket(host, port), backlog=LISTEN_BACKLOG)
+    metrics_server = await start_metrics_server()
+    snapshots_task = asyncio.create_task(send_presence_snapshots()) if PRESENCE_SNAPSHOT_INTERVAL else None
+    flush_task = asyncio.create_task(flush_histories()) if HISTORY_DIR else None
+    try:
+        async with server:
+            # Воркер завершается вместе с шиной
+            await read_bus(bus_reader)
+    except asyncio.CancelledError:
+        pass
+
+
+# Воркер запускается через spawn, поэтому настройки (значения констант модуля) передаются ему явно.
+# Журналы всех воркеров лежат в общем каталоге: журнал комнаты пишет только ее хранитель
+def worker_process(host, port, bus_path, settings):
+    globals().update(settings)
+    log_listener = configure_logging()
+    try:
+        run_event_loop(run_worker(host, port, bus_path))
+    except KeyboardInterrupt:
+        pass
     finally:
-        # Удаление клиента и обновление списка активных пользователей
-        if room in clients:
-            clients[room] = [client for client in clients[room] if client[1] != writer]
-            await send_active_users_to_room(room)
+        if HISTORY_DIR:
+            flush_all_histories()
+        log_listener.stop()
 
-        print(f"Клиент {username}{addr} отключился из комнаты {room}")
-        await send_message_to_room(room, f"{username} покинул комнату.")
 
-        writer.close()
-        await writer.wait_closed()
+def run_event_loop(coroutine):
+    if EVENT_LOOP == "uvloop":
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(coroutine)
 
 
-async def send_active_users_to_room(room):
-    if room in clients:
-        active_users = [client[0] for client in clients[room]]
-        message = f"Активные пользователи в комнате {room}: {', '.join(active_users)}\n"
-        for _, writer in clients[room]:
-            writer.write(message.encode())
-            await writer.drain()
+# SIGTERM отменяет главную задачу процесса, чтобы выполнились блоки finally (остановка воркеров, запись журналов)
+def stop_on_sigterm():
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:  # Windows
+        pass
 
 
-async def send_message_to_room(room, message):
-    if room in clients:
-        for username, writer in clients[room]:
-            writer.write(f"{message}\n".encode())
-            await writer.drain()
+async def run_bus(bus_socket):
+    stop_on_sigterm()
+    bus = await asyncio.start_unix_server(handle_bus_worker, sock=bus_socket)
+    try:
+        async with bus:
+            await bus.serve_forever()
+    except asyncio.CancelledError:
+        pass
+
+
+# Несколько процессов-воркеров на одном порту; только Linux и другие системы с SO_REUSEPORT
+def run_sharded(host, port, workers_count):
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "AF_UNIX"):
+        raise RuntimeError("Режим нескольких процессов требует SO_REUSEPORT и Unix-сокетов")
+
+    bus_dir = tempfile.mkdtemp(prefix="chat_bus_")
+    bus_path = os.path.join(bus_dir, "bus.sock")
+    bus_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    bus_socket.bind(bus_path)
+    bus_socket.listen()
+
+    # spawn: воркеры не наследуют сокет шины и состояние родительского процесса
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=worker_process, daemon=True,
+                               args=(host, port, bus_path, worker_settings(index)))
+               for index in range(workers_count)]
+    for worker in workers:
+        worker.start()
+    log_event(logging.INFO, "Сервер запущен", host=host, port=port, workers=workers_count)
 
-async def main():
-    server = await asyncio.start_server(handle_client, '0.0.0.0', 8888)
+    # При SIGTERM воркеры тоже останавливаются, а файл сокета шины удаляется
+    try:
+        run_event_loop(run_bus(bus_socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        os.unlink(bus_path)
+        os.rmdir(bus_dir)
+
+
+def worker_settings(index):
+    return {
+        "EVENT_LOOP": EVENT_LOOP,
+        "OUTBOUND_QUEUE_SIZE": OUTBOUND_QUEUE_SIZE,
+        "SLOW_CLIENT_POLICY": SLOW_CLIENT_POLICY,
+        "HISTORY_DIR": HISTORY_DIR,
+        "METRICS_PORT": METRICS_PORT and METRICS_PORT + index,
+        "LOG_LEVEL": LOG_LEVEL,
+        "LOG_FORMAT": LOG_FORMAT
+    }
+
+
+async def main(host="0.0.0.0", port=8888):
+    stop_on_sigterm()
+    server = await asyncio.start_server(handle_client, host, port, backlog=LISTEN_BACKLOG)
+    metrics_server = await start_metrics_server()
     addr = server.sockets[0].getsockname()
-    print(f"Сервер запущен на {addr}")
-    async with server:
-        await server.serve_forever()
+    log_event(logging.INFO, "Сервер запущен", addr=addr)
+    snapshots_task = asyncio.create_task(send_presence_snapshots()) if PRESENCE_SNAPSHOT_INTERVAL else None
+    flush_task = asyncio.create_task(flush_histories()) if HISTORY_DIR else None
+    try:
+        async with server:
+            await server.serve_forever()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        if HISTORY_DIR:
+            flush_all_histories()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сервер чата")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--workers", type=int, default=1, help="число процессов на общем порту")
+    parser.add_argument("--slow-client-policy", dest="slow_client_policy", choices=["drop", "disconnect", "coalesce"],
+                        default=SLOW_CLIENT_POLICY, help="что делать с клиентом, у которого переполнилась очередь")
+    parser.add_argument("--outbound-queue-size", dest="outbound_queue_size", type=int, default=OUTBOUND_QUEUE_SIZE,
+                        help="размер очереди исходящих сообщений клиента")
+    parser.add_argument("--history-dir", dest="history_dir", help="каталог журналов истории комнат")
+    parser.add_argument("--loop", choices=["asyncio", "uvloop"], default=EVENT_LOOP, help="реализация цикла событий")
+    parser.add_argument("--log-level", dest="log_level", default=LOG_LEVEL, help="DEBUG — с каждым сообщением чата")
+    parser.add_argument("--log-format", dest="log_format", choices=["text", "json"], default=LOG_FORMAT)
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, help="порт HTTP-метрик (GET /metrics) на 127.0.0.1")
+    arguments = parser.parse_args()
 
-asyncio.run(main())
+    SLOW_CLIENT_POLICY = arguments.slow_client_policy
+    OUTBOUND_QUEUE_SIZE = arguments.outbound_queue_size
+    HISTORY_DIR = arguments.history_dir
+    EVENT_LOOP = arguments.loop
+    LOG_LEVEL = arguments.log_level
+    LOG_FORMAT = arguments.log_format
+    METRICS_PORT = arguments.metrics_port
+    log_listener = configure_logging()
+    try:
+        if arguments.workers > 1:
+            run_sharded(arguments.host, arguments.port, arguments.workers)
+        else:
+            run_event_loop(main(arguments.host, arguments.port))
+    finally:
+        log_listener.stop()
@@ -0,0 +1,70 @@
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import chain
+
+# Поиск авторов по части имени без учета регистра. Индекс строится один раз:
+# имена в нижнем регистре по алфавиту, слова имен по алфавиту и n-граммы (2 и 3 символа) -> номера имен.
+# Результаты ранжируются: сначала имена, начинающиеся с запроса, затем имена, в которых с запроса начинается
+# другое слово (по алфавиту слов), затем остальные имена, содержащие запрос; внутри группы — по алфавиту.
+# Каждая группа перебирается лениво до limit результатов
+GRAM_SIZES = (2, 3)
+
+
+def name_grams(name, size):
+    return {name[index:index + size] for index in range(len(name) - size + 1)}
+
+
+class AuthorSearch:
+    def __init__(self, authors):
+        normalized = sorted((author.lower(), author) for author in set(authors))
+        self.names = [name for name, _ in normalized]
+        self.authors = [author for _, author in normalized]
+        self.words = sorted((word, position) for position, name in enumerate(self.names) for word in name.split()[1:])
+        grams = defaultdict(lambda: array("I"))
+        for position, name in enumerate(self.names):
+            for size in GRAM_SIZES:
+                for gram in name_grams(name, size):
+                    grams[gram].append(position)
+        self.grams = dict(grams)
+
+    # Имена, начинающиеся с query
+    def prefix_matches(self, query):
+        for position in range(bisect_left(self.names, query), len(self.names)):
+            if not self.names[position].startswith(query):
+                break
+            yield position
+
+    # Имена, в которых с query начинается не первое слово
+    def word_matches(self, query):
+        for index in range(bisect_left(self.words, (query,)), len(self.words)):
+            word, position = self.words[index]
+            if not word.startswith(query):
+                break
+            yield position
+
+    # Имена, содержащие query. Кандидаты — имена с самой редкой n-граммой запроса (по алфавиту), они проверяются
+    # целиком; запрос из одного символа проверяется по всем именам
+    def substring_matches(self, query):
+        size = min(len(query), GRAM_SIZES[-1])
+        if size < GRAM_SIZES[0]:
+            candidates = range(len(self.names))
+        else:
+            candidates = min((self.grams.get(gram, ()) for gram in name_grams(query, size)), key=len)
+        return (position for position in candidates if query in self.names[position])
+
+    # До limit авторов, в имени которых есть query, в порядке ранжирования
+    def search(self, query, limit):
+        query = query.strip().lower()
+        if not query:
+            return []
+
+        found = []
+        seen = set()
+        for position in chain(self.prefix_matches(query), self.word_matches(query), self.substring_matches(query)):
+            if position not in seen:
+                seen.add(position)
+                found.append(self.authors[position])
+                if len(found) == limit:
+                    break
+        return found
@@ -0,0 +1,160 @@
+from array import array
+from collections import defaultdict
+from functools import cached_property
+from itertools import chain
+
+from catalogue import TOKEN_PATTERN, Catalogue
+
+# Веса признаков в рейтинге соответствия
+GENRE_WEIGHT = 10
+AUTHOR_WEIGHT = 5
+KEYWORD_WEIGHT = 2
+
+# Индекс каталога. Книга обозначается номером в books — списке из books.json или скомпилированном каталоге
+# (catalogue.py). Жанры и авторы (в нижнем регистре) и слова описаний отображаются на номера книг, поэтому
+# рейтинг считается только для подходящих книг. Для каталога списки книг по жанрам, авторам и словам описаний
+# берутся из файла; для списка из books.json слова описаний и названия в нижнем регистре обрабатываются
+# при первом обращении к ним.
+# С векторами TF-IDF (tfidf.py) ключевые слова оцениваются по сходству текста, а не по вхождению подстроки
+class BookIndex:
+    def __init__(self, books, vectors=None):
+        self.books = books
+        self.vectors = vectors
+        if isinstance(books, Catalogue):
+            self.years = books.years
+            self.book_genres = books.genres
+            self.book_titles = books.titles
+            self.descriptions = books.descriptions
+            self.genre_names = set(books.genre_names)
+            self.author_names = set(books.author_names)
+            self.genres = self.name_postings(books.genre_names, books.genre_books)
+            self.authors = self.name_postings(books.author_names, books.author_books)
+        else:
+            self.years = [book.get("first_publish_year", 0) for book in books]
+            self.book_genres = [book["genre"] for book in books]
+            self.book_titles = [book.get("title", "") for book in books]
+            self.descriptions = [book["description"] for book in books]
+            self.genre_names = set(self.book_genres)
+            self.author_names = {author for book in books for author in book["author"]}
+            genres = defaultdict(list)
+            authors = defaultdict(list)
+            for book_id, book in enumerate(books):
+                genres[book["genre"].lower()].append(book_id)
+                for author in {author.lower() for author in book["author"]}:
+                    authors[author].append(book_id)
+            self.genres = dict(genres)
+            self.authors = dict(authors)
+        self.token_matches = {}
+        self.orderings = {}
+        self.last_query = None
+        self.last_scores = None
+
+    # Списки книг по именам без учета регистра: name_books(номер имени) — книги с этим именем
+    @staticmethod
+    def name_postings(names, name_books):
+        postings = {}
+        for name_id, name in enumerate(names):
+            key = name.lower()
+            book_ids = name_books(name_id)
+            postings[key] = list(chain(postings[key], book_ids)) if key in postings else book_ids
+        return postings
+
+    @cached_property
+    def titles(self):
+        return [title.lower() for title in self.book_titles]
+
+    # Инвертированный индекс слов описаний для списка из books.json: {слово в нижнем регистре: номера книг}
+    @cached_property
+    def tokens(self):
+        tokens = defaultdict(list)
+        for book_id, description in enumerate(self.descriptions):
+            for token in set(TOKEN_PATTERN.findall(description.lower())):
+                tokens[token].append(book_id)
+        return dict(tokens)
+
+    # Списки книг для слов описаний, содержащих part; словарь просматривается один раз для каждой части
+    def part_postings(self, part):
+        if part not in self.token_matches:
+            if isinstance(self.books, Catalogue):
+                postings = [self.books.token_books(token_id) for token_id in self.books.tokens_containing(part)]
+            else:
+                postings = [book_ids for token, book_ids in self.tokens.items() if part in token]
+            self.token_matches[part] = postings
+        return self.token_matches[part]
+
+    # Книги, в описании которых ключевое слово встречается как подстрока.
+    # Часть ключевого слова из букв и цифр всегда лежит внутри одного слова описания, поэтому
+    # кандидаты — книги со словами, содержащими самую длинную такую часть; остальное проверяется по тексту.
+    # Ключевое слово без букв и цифр (знаки препинания) не ищется
+    def keyword_books(self, keyword):
+        keyword = keyword.lower()
+        parts = TOKEN_PATTERN.findall(keyword)
+        if not parts:
+            return set()
+
+        part = max(parts, key=len)
+        candidates = set()
+        for book_ids in self.part_postings(part):
+            candidates.update(book_ids)
+        if keyword == part:
+            return candidates
+        return {book_id for book_id in candidates if keyword in self.descriptions[book_id].lower()}
+
+    # Книги, у которых значение признака (жанр или автор) совпадает с одним из выбранных без учета регистра
+    @staticmethod
+    def lookup(postings, values):
+        found = set()
+        for value in {value.lower() for value in values}:
+            found.update(postings.get(value, ()))
+        return found
+
+    # Порядок книг для дополнительной сортировки ("alphabet" — по названию, "year" — по году, иначе порядок каталога).
+    # Возвращает номера книг в этом порядке и место каждой книги в нем; при равных значениях книги идут
+    # в порядке каталога и при убывании. Строится один раз для каждого варианта сортировки
+    def ordering(self, sort_option, descending=False):
+        key = (sort_option, descending)
+        if key not in self.orderings:
+            values = {"alphabet": self.titles, "year": self.years}.get(sort_option)
+            if values is None:
+                order = range(len(self.books))
+            else:
+                order = array("I", sorted(range(len(self.books)), key=values.__getitem__, reverse=descending))
+            positions = array("I", bytes(4 * len(self.books)))
+            for position, book_id in enumerate(order):
+                positions[book_id] = position
+            self.orderings[key] = (order, positions)
+        return self.orderings[key]
+
+    # Рейтинг соответствия книг, подходящих хотя бы по одному признаку: {номер книги: рейтинг}.
+    # У остальных книг рейтинг 0. Последний результат запоминается: страницы одного запроса считают его один раз
+    def match_scores(self, preferences):
+        query = (tuple(preferences["genres"]), tuple(preferences["authors"]), tuple(preferences["keywords"]))
+        if query != self.last_query:
+            self.last_scores = self.calculate_scores(preferences)
+            self.last_query = query
+        return self.last_scores
+
+    def calculate_scores(self, preferences):
+        genre_books = self.lookup(self.genres, preferences["genres"])
+        author_books = self.lookup(self.authors, preferences["authors"])
+        keyword_scores = self.keyword_scores([keyword for keyword in preferences["keywords"] if keyword.strip()])
+
+        return {
+            book_id: GENRE_WEIGHT * (book_id in genre_books)
+                     + AUTHOR_WEIGHT * (book_id in author_books)
+                     + keyword_scores.get(book_id, 0)
+            for book_id in genre_books | author_books | keyword_scores.keys()
+        }
+
+    # Часть рейтинга за ключевые слова: KEYWORD_WEIGHT за вхождение любого из них в описание или,
+    # с векторами TF-IDF, до KEYWORD_WEIGHT пропорционально сходству (у самой похожей книги — KEYWORD_WEIGHT)
+    def keyword_scores(self, keywords):
+        if self.vectors is None:
+            keyword_books = set()
+            for keyword in keywords:
+                keyword_books.update(self.keyword_books(keyword))
+            return dict.fromkeys(keyword_books, KEYWORD_WEIGHT)
+
+        similarities = self.vectors.similarities(keywords)
+        best = max(similarities.values(), default=0)
+        return {book_id: round(KEYWORD_WEIGHT * similarity / best, 2) for book_id, similarity in similarities.items()}
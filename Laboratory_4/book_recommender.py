@@ -2,15 +2,45 @@ import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from openpyxl import Workbook
 from openpyxl.utils import get_column_letter
+import heapq
 import json
+import os
+from itertools import islice
 
-tree = None  # Глобальная переменная для таблицы рекомендаций
+from author_search import AuthorSearch
+from book_index import AUTHOR_WEIGHT, GENRE_WEIGHT, KEYWORD_WEIGHT, BookIndex
+from catalogue import Catalogue
 
-# Загружает базу данных книг из JSON-файла
+tree = None  # Глобальная переменная для таблицы рекомендаций
+RESULTS_PAGE_SIZE = 100  # Рекомендаций, загружаемых в таблицу за раз
+SUGGESTIONS_LIMIT = 20  # Предложений авторов под строкой поиска
+AUTHOR_SEARCH_DELAY = 150  # Пауза в наборе (мс), после которой обновляются предложения авторов
+suggestion_buttons = []  # Кнопки предложений создаются один раз и переиспользуются
+pending_author_search = None  # Отложенное обновление предложений (after)
+
+# Загружает базу данных книг: скомпилированный каталог (python catalogue.py books.json books.catalogue)
+# открывается без разбора, исходный JSON-файл читается целиком
 def load_books(filename="books.json"):
+    if not filename.endswith(".json"):
+        return Catalogue(filename)
     with open(filename, "r", encoding="utf-8") as file:
         return json.load(file)
 
+# Скомпилированный каталог, если он собран не раньше последнего изменения JSON-файла, иначе JSON-файл
+def books_source(json_filename="books.json", catalogue_filename="books.catalogue"):
+    if os.path.exists(catalogue_filename) and (not os.path.exists(json_filename) or
+                                               os.path.getmtime(catalogue_filename) >= os.path.getmtime(json_filename)):
+        return catalogue_filename
+    return json_filename
+
+# Векторы TF-IDF для ранжирования по сходству текста (python tfidf.py books.json), если они собраны для этого каталога.
+# Без них ключевые слова ищутся в описаниях как подстроки; NumPy нужен только для векторов
+def load_vectors(books_count, books_filename, directory="books.tfidf"):
+    if not os.path.exists(directory):
+        return None
+    from tfidf import open_vectors
+    return open_vectors(books_count, books_filename, directory)
+
 # Генерирует словарь предпочтений пользователя, включающий жанры, авторов и ключевые слова
 def process_preferences(genres, authors, keywords):
     return {
@@ -31,47 +61,68 @@ def filter_books(books, genre=None, year=None):
 def calculate_match(book, preferences):
     match_score = 0
     if book["genre"].lower() in (genre.lower() for genre in preferences["genres"]):
-        match_score += 10
+        match_score += GENRE_WEIGHT
     if any(author.lower() in (auth.lower() for auth in preferences["authors"]) for author in book["author"]):
-        match_score += 5
+        match_score += AUTHOR_WEIGHT
     if any(keyword.strip() and keyword.lower() in book["description"].lower() for keyword in preferences["keywords"]):
-        match_score += 2
+        match_score += KEYWORD_WEIGHT
     return match_score
 
-# Рекомендует книги на основе предпочтений пользователя и рассчитанных "рейтингом соответствия"
-def recommend_books(books, preferences):
-    rated_books = [(book, calculate_match(book, preferences)) for book in books]
-    return sorted(rated_books, key=lambda x: x[1], reverse=True)
+# Рекомендует книги на основе предпочтений пользователя и "рейтинга соответствия": страница из limit книг,
+# начиная с offset, по убыванию рейтинга, а при равном рейтинге — в порядке сортировки sort_option.
+# book_filter(номер книги) отбирает книги. Из книг с ненулевым рейтингом куча выбирает только offset + limit лучших,
+# а книги с рейтингом 0 берутся из заранее отсортированного порядка, пока страница не заполнится
+def recommend_books(book_index, preferences, book_filter=None, sort_option=None, descending=False, offset=0, limit=None):
+    scores = book_index.match_scores(preferences)
+    order, positions = book_index.ordering(sort_option, descending)
+    count = len(book_index.books) if limit is None else offset + limit
+
+    matched = [book_id for book_id in scores if book_filter is None or book_filter(book_id)]
+    top = heapq.nsmallest(count, matched, key=lambda book_id: (-scores[book_id], positions[book_id]))
+    if len(top) < count:
+        unmatched = (book_id for book_id in order
+                     if book_id not in scores and (book_filter is None or book_filter(book_id)))
+        top.extend(islice(unmatched, count - len(top)))
+
+    return [(book_index.books[book_id], scores.get(book_id, 0)) for book_id in top[offset:]]
 
 # Обновляет текстовую строку с выбранными авторами
 def update_selected_authors(selected_authors, selected_authors_text):
     authors_text = ", ".join(selected_authors)
     selected_authors_text.set(authors_text)
 
-# Обновляет список предложений авторов на основе введенного текста поиска
-def update_author_suggestions(authors, author_search_entry, suggestions_frame, select_author):
-    for widget in suggestions_frame.winfo_children():
-        widget.destroy()
-
-    query = author_search_entry.get().strip().lower()
-    if not query:
-        return
-
-    matching_authors = [author for author in authors if query in author.lower()]
-    for author in matching_authors[:20]:
-        btn = tk.Button(
-            suggestions_frame,
-            text=author,
-            command=lambda a=author: select_author(a),
-            anchor="w",
-            relief="flat",
-            bg="#f0f0f0",
-        )
-        btn.config(width=70)
-        btn.pack(fill="x", padx=5, pady=2)
+# Обновляет список предложений авторов на основе введенного текста поиска.
+# Кнопки из suggestion_buttons получают новые имена, лишние скрываются
+def update_author_suggestions(author_search, author_search_entry, suggestions_frame, select_author):
+    if not suggestion_buttons:
+        for _ in range(SUGGESTIONS_LIMIT):
+            btn = tk.Button(suggestions_frame, anchor="w", relief="flat", bg="#f0f0f0")
+            btn.config(width=70)
+            suggestion_buttons.append(btn)
+
+    matching_authors = author_search.search(author_search_entry.get(), SUGGESTIONS_LIMIT)
+    for btn, author in zip(suggestion_buttons, matching_authors):
+        btn.config(text=author, command=lambda a=author: select_author(a))
+        if not btn.winfo_manager():
+            btn.pack(fill="x", padx=5, pady=2)
+    for btn in suggestion_buttons[len(matching_authors):]:
+        btn.pack_forget()
+
+# Откладывает обновление предложений до паузы в наборе: при быстром вводе поиск выполняется один раз
+def schedule_author_suggestions(author_search, author_search_entry, suggestions_frame, select_author):
+    global pending_author_search
+    if pending_author_search is not None:
+        author_search_entry.after_cancel(pending_author_search)
+
+    def run():
+        global pending_author_search
+        pending_author_search = None
+        update_author_suggestions(author_search, author_search_entry, suggestions_frame, select_author)
+
+    pending_author_search = author_search_entry.after(AUTHOR_SEARCH_DELAY, run)
 
 # Обрабатывает выбор автора и добавляет/удаляет его из списка выбранных авторов
-def select_author(author, selected_authors, selected_authors_text, author_search_entry, update_author_suggestions, authors, suggestions_frame):
+def select_author(author, selected_authors, selected_authors_text, author_search_entry, update_author_suggestions, author_search, suggestions_frame):
     if author in selected_authors:
         response = messagebox.askyesno(
             "Подтверждение", f"Автор '{author}' уже выбран. Удалить его из списка?"
@@ -82,10 +133,12 @@ def select_author(author, selected_authors, selected_authors_text, author_search
         selected_authors.add(author)
     update_selected_authors(selected_authors, selected_authors_text)
     author_search_entry.delete(0, tk.END)
-    update_author_suggestions(authors, author_search_entry, suggestions_frame, lambda a: select_author(a, selected_authors, selected_authors_text, author_search_entry, update_author_suggestions, authors, suggestions_frame))
+    update_author_suggestions(author_search, author_search_entry, suggestions_frame, lambda a: select_author(a, selected_authors, selected_authors_text, author_search_entry, update_author_suggestions, author_search, suggestions_frame))
 
-# Отображает список рекомендаций в виде таблицы с книгами и их характеристиками
-def show_recommendations(recommendations, results_frame):
+# Отображает рекомендации в виде таблицы с книгами и их характеристиками.
+# fetch_page(offset, limit) возвращает страницу рекомендаций; следующая страница загружается,
+# когда таблица прокручена до конца
+def show_recommendations(fetch_page, results_frame):
     global tree
 
     for widget in results_frame.winfo_children():
@@ -98,41 +151,52 @@ def show_recommendations(recommendations, results_frame):
         tree.heading(col, text=col)
         tree.column(col, anchor="w", stretch=True, width=130)
 
-    for book, score in recommendations:
-        authors = ", ".join(book["author"])
-        tree.insert("", "end", values=(book["title"], authors, book["first_publish_year"], book["genre"], score))
-
     scrollbar = ttk.Scrollbar(results_frame, orient="vertical", command=tree.yview)
-    tree.configure(yscrollcommand=scrollbar.set)
+    loaded = {"count": 0, "finished": False}
+
+    def load_page():
+        page = fetch_page(loaded["count"], RESULTS_PAGE_SIZE)
+        for book, score in page:
+            authors = ", ".join(book["author"])
+            tree.insert("", "end", values=(book["title"], authors, book["first_publish_year"], book["genre"], score))
+        loaded["count"] += len(page)
+        loaded["finished"] = len(page) < RESULTS_PAGE_SIZE
+
+    def on_scroll(first, last):
+        scrollbar.set(first, last)
+        if float(last) >= 1.0 and not loaded["finished"]:
+            load_page()
+
+    tree.configure(yscrollcommand=on_scroll)
+    load_page()
 
     tree.grid(row=0, column=0, sticky="nsew", pady=(6, 0))
     scrollbar.grid(row=0, column=1, sticky="ns", pady=(6, 0))
 
 # Собирает и фильтрует данные, а затем запускает функцию для отображения рекомендаций
-def get_recommendations(books, genre_vars, selected_authors, keywords_entry, year_from_entry, year_to_entry, sort_option, sort_order, only_selected_genres_var, show_recommendations, results_frame):
+def get_recommendations(book_index, genre_vars, selected_authors, keywords_entry, year_from_entry, year_to_entry, sort_option, sort_order, only_selected_genres_var, show_recommendations, results_frame):
     selected_genres = [genre for genre, var in genre_vars.items() if var.get()]
     selected_authors_list = list(selected_authors)
     keywords = keywords_entry.get().split(", ")
     preferences = process_preferences(selected_genres, selected_authors_list, keywords)
 
-    filtered_books = books if not only_selected_genres_var.get() else [book for book in books if book["genre"] in selected_genres]
+    only_selected_genres = only_selected_genres_var.get()
+    selected_genres_set = set(selected_genres)
 
     year_from = year_from_entry.get().strip()
     year_to = year_to_entry.get().strip()
+    year_range = (int(year_from), int(year_to)) if year_from.isdigit() and year_to.isdigit() else None
 
-    if year_from.isdigit() and year_to.isdigit():
-        year_from = int(year_from)
-        year_to = int(year_to)
-        filtered_books = [book for book in filtered_books if year_from <= book.get("first_publish_year", 0) <= year_to]
+    def book_filter(book_id):
+        return ((not only_selected_genres or book_index.book_genres[book_id] in selected_genres_set) and
+                (year_range is None or year_range[0] <= book_index.years[book_id] <= year_range[1]))
 
-    sort_reverse = (sort_order.get() == "desc")
-    if sort_option.get() == "alphabet":
-        filtered_books.sort(key=lambda x: x.get("title", "").lower(), reverse=sort_reverse)
-    elif sort_option.get() == "year":
-        filtered_books.sort(key=lambda x: x.get("first_publish_year", 0), reverse=sort_reverse)
-
-    recommendations = recommend_books(filtered_books, preferences)
-    show_recommendations(recommendations, results_frame)
+    filtered = only_selected_genres or year_range is not None
+    show_recommendations(
+        lambda offset, limit: recommend_books(book_index, preferences, book_filter if filtered else None,
+                                              sort_option.get(), sort_order.get() == "desc", offset, limit),
+        results_frame
+    )
 
 # Сохраняет выбранные книги в Excel-файл
 def save_to_read_list(tree, max_col_width=70):
@@ -179,9 +243,11 @@ root.title("Рекомендательная система книг")
 root.geometry("1200x650")
 root.resizable(False, False)
 
-books = load_books()
-genres = sorted({book["genre"] for book in books})
-authors = sorted({author for book in books for author in book["author"]})
+books_filename = books_source()
+books = load_books(books_filename)
+book_index = BookIndex(books, load_vectors(len(books), books_filename))
+genres = sorted(book_index.genre_names)
+author_search = AuthorSearch(book_index.author_names)
 
 main_frame = tk.Frame(root)
 main_frame.pack(padx=10, pady=5, fill="both", expand=True)
@@ -243,7 +309,7 @@ suggestions_frame.bind("<Configure>", lambda e: canvas.configure(scrollregion=ca
 
 selected_authors = set()
 
-author_search_entry.bind("<KeyRelease>", lambda e: update_author_suggestions(authors, author_search_entry, suggestions_frame, lambda a: select_author(a, selected_authors, selected_authors_text, author_search_entry, update_author_suggestions, authors, suggestions_frame)))
+author_search_entry.bind("<KeyRelease>", lambda e: schedule_author_suggestions(author_search, author_search_entry, suggestions_frame, lambda a: select_author(a, selected_authors, selected_authors_text, author_search_entry, update_author_suggestions, author_search, suggestions_frame)))
 
 keywords_frame = tk.LabelFrame(main_frame, text="Ключевые слова", padx=10, pady=10)
 keywords_frame.grid(row=3, column=0, columnspan=2, sticky="nsew")
@@ -291,7 +357,7 @@ recommend_button = tk.Button(
     actions_frame, 
     text="Получить рекомендации", 
     command=lambda: get_recommendations(
-        books, genre_vars, selected_authors, keywords_entry, year_from_entry, 
+        book_index, genre_vars, selected_authors, keywords_entry, year_from_entry, 
         year_to_entry, sort_option, sort_order, only_selected_genres_var, 
         show_recommendations, results_inner_frame
     )
@@ -0,0 +1,286 @@
+import argparse
+import hashlib
+import json
+import mmap
+import re
+import sys
+from array import array
+from bisect import bisect_right
+from collections.abc import Mapping, Sequence
+
+# Скомпилированный каталог книг: один файл, который открывается через mmap без разбора.
+# Жанры и авторы хранятся один раз (номера вместо строк), года — массивом, названия и описания —
+# в кучах строк UTF-8 со смещениями; описание декодируется только при обращении к нему.
+# Для жанров, авторов и слов описаний заранее записаны списки книг, поэтому индекс (book_index.py) строится
+# и ищет по ключевым словам без обхода каталога.
+# Формат: MAGIC, длина заголовка (4 байта), заголовок JSON {"books": n, "source": отпечаток JSON-файла,
+# "sections": {имя: [смещение, длина, тип]}},
+# затем секции — массивы в порядке байтов машины, на которой собран каталог
+MAGIC = b"BOOKCAT1"
+FORMAT_VERSION = 2
+ALIGNMENT = 8
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+FIELDS = ("title", "author", "genre", "first_publish_year", "description")
+
+
+# Строки из кучи UTF-8: i-я строка — heap[offsets[i]:offsets[i + 1]]
+class StringHeap(Sequence):
+    def __init__(self, offsets, heap):
+        self.offsets = offsets
+        self.heap = heap
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return str(self.heap[self.offsets[index]:self.offsets[index + 1]], "utf-8")
+
+
+# Столбец строк, заданный номерами: i-е значение — names[ids[i]]
+class InternedColumn(Sequence):
+    def __init__(self, ids, names):
+        self.ids = ids
+        self.names = names
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.names[book_id] for book_id in self.ids[index]]
+        return self.names[self.ids[index]]
+
+
+# Книга каталога: ведет себя как словарь из books.json, значения читаются из столбцов при обращении
+class Book(Mapping):
+    def __init__(self, catalogue, book_id):
+        self.catalogue = catalogue
+        self.book_id = book_id
+
+    def __getitem__(self, field):
+        catalogue = self.catalogue
+        if field == "title":
+            return catalogue.titles[self.book_id]
+        if field == "author":
+            return catalogue.book_authors(self.book_id)
+        if field == "genre":
+            return catalogue.genres[self.book_id]
+        if field == "first_publish_year":
+            return catalogue.years[self.book_id]
+        if field == "description":
+            return catalogue.descriptions[self.book_id]
+        raise KeyError(field)
+
+    def __iter__(self):
+        return iter(FIELDS)
+
+    def __len__(self):
+        return len(FIELDS)
+
+
+# Открытый скомпилированный каталог: последовательность книг (Book) и столбцы
+class Catalogue(Sequence):
+    def __init__(self, filename):
+        with open(filename, "rb") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.buffer)
+
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{filename}: это не скомпилированный каталог книг")
+        header_size = int.from_bytes(view[len(MAGIC):len(MAGIC) + 4], "little")
+        header = json.loads(bytes(view[len(MAGIC) + 4:len(MAGIC) + 4 + header_size]))
+        if header["version"] != FORMAT_VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{filename}: каталог собран в другом формате, соберите его заново")
+
+        self.count = header["books"]
+        self.source = header.get("source")
+        sections = {name: view[offset:offset + length].cast(typecode)
+                    for name, (offset, length, typecode) in header["sections"].items()}
+
+        self.years = sections["years"]
+        self.genre_ids = sections["genre_ids"]
+        self.author_offsets = sections["author_offsets"]
+        self.author_ids = sections["author_ids"]
+        self.titles = StringHeap(sections["title_offsets"], sections["titles"])
+        self.descriptions = StringHeap(sections["description_offsets"], sections["descriptions"])
+        self.genre_names = list(StringHeap(sections["genre_name_offsets"], sections["genre_names"]))
+        self.author_names = list(StringHeap(sections["author_name_offsets"], sections["author_names"]))
+        self.genres = InternedColumn(self.genre_ids, self.genre_names)
+        # Книги каждого жанра и каждого автора: books_by_genre[genre_offsets[g]:genre_offsets[g + 1]]
+        self.genre_offsets = sections["genre_offsets"]
+        self.books_by_genre = sections["books_by_genre"]
+        self.author_book_offsets = sections["author_book_offsets"]
+        self.books_by_author = sections["books_by_author"]
+        # Слова описаний в нижнем регистре, каждое с "\n" в конце: слово t — token_names[token_name_offsets[t]:...];
+        # подстрока ищется по всей куче сразу, без декодирования слов
+        self.token_name_offsets = sections["token_name_offsets"]
+        self.token_names_start, token_names_length, _ = header["sections"]["token_names"]
+        self.token_names_end = self.token_names_start + token_names_length
+        self.token_offsets = sections["token_offsets"]
+        self.books_by_token = sections["books_by_token"]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, book_id):
+        if isinstance(book_id, slice):
+            return [Book(self, i) for i in range(*book_id.indices(self.count))]
+        if book_id < 0:
+            book_id += self.count
+        if not 0 <= book_id < self.count:
+            raise IndexError(book_id)
+        return Book(self, book_id)
+
+    def book_authors(self, book_id):
+        return [self.author_names[author_id]
+                for author_id in self.author_ids[self.author_offsets[book_id]:self.author_offsets[book_id + 1]]]
+
+    def genre_books(self, genre_id):
+        return self.books_by_genre[self.genre_offsets[genre_id]:self.genre_offsets[genre_id + 1]]
+
+    def author_books(self, author_id):
+        return self.books_by_author[self.author_book_offsets[author_id]:self.author_book_offsets[author_id + 1]]
+
+    def token_books(self, token_id):
+        return self.books_by_token[self.token_offsets[token_id]:self.token_offsets[token_id + 1]]
+
+    # Номера слов описаний, содержащих part (слово в нижнем регистре из букв и цифр)
+    def tokens_containing(self, part):
+        pattern = part.encode("utf-8")
+        token_ids = []
+        position = self.buffer.find(pattern, self.token_names_start, self.token_names_end)
+        while position != -1:
+            token_id = bisect_right(self.token_name_offsets, position - self.token_names_start) - 1
+            token_ids.append(token_id)
+            next_token = self.token_names_start + self.token_name_offsets[token_id + 1]
+            position = self.buffer.find(pattern, next_token, self.token_names_end)
+        return token_ids
+
+
+# Номера строк в порядке первого появления: {строка: номер}
+def intern(values, names):
+    return [names.setdefault(value, len(names)) for value in values]
+
+def string_heap(strings):
+    offsets = array("Q", [0])
+    heap = bytearray()
+    for string in strings:
+        heap += string.encode("utf-8")
+        offsets.append(len(heap))
+    return offsets, heap
+
+# Книги каждого значения: номера книг, сгруппированные по значению, и смещения групп
+def group_books(values_by_book):
+    groups = []
+    for book_id, values in enumerate(values_by_book):
+        for value in values:
+            while value >= len(groups):
+                groups.append(array("I"))
+            groups[value].append(book_id)
+    offsets = array("I", [0])
+    books = array("I")
+    for group in groups:
+        books.extend(group)
+        offsets.append(len(books))
+    return offsets, books
+
+# Отпечаток исходных данных: SHA-256 JSON-файла; для каталога — отпечаток JSON-файла, из которого он собран
+# (записан в заголовке), а если он не записан — SHA-256 самого каталога
+def source_fingerprint(filename):
+    if not filename.endswith(".json"):
+        source = Catalogue(filename).source
+        if source is not None:
+            return source
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Компилирует список книг (в формате books.json) в файл каталога; source — отпечаток исходного JSON-файла
+def compile_catalogue(books, filename, source=None):
+    genre_names = {}
+    author_names = {}
+    genre_ids = array("I", intern((book["genre"] for book in books), genre_names))
+    books_authors = [intern(book["author"], author_names) for book in books]
+
+    author_offsets = array("I", [0])
+    author_ids = array("I")
+    for book_author_ids in books_authors:
+        author_ids.extend(book_author_ids)
+        author_offsets.append(len(author_ids))
+
+    title_offsets, titles = string_heap(book.get("title", "") for book in books)
+    description_offsets, descriptions = string_heap(book["description"] for book in books)
+    genre_name_offsets, genre_name_heap = string_heap(genre_names)
+    author_name_offsets, author_name_heap = string_heap(author_names)
+    genre_offsets, books_by_genre = group_books([genre_id] for genre_id in genre_ids)
+    author_book_offsets, books_by_author = group_books(set(book_author_ids) for book_author_ids in books_authors)
+    token_names = {}
+    token_offsets, books_by_token = group_books(
+        intern(dict.fromkeys(TOKEN_PATTERN.findall(book["description"].lower())), token_names) for book in books)
+    token_name_offsets, token_name_heap = string_heap(token + "\n" for token in token_names)
+
+    sections = {
+        "years": array("i", (book.get("first_publish_year", 0) for book in books)),
+        "genre_ids": genre_ids,
+        "author_offsets": author_offsets,
+        "author_ids": author_ids,
+        "title_offsets": title_offsets,
+        "titles": titles,
+        "description_offsets": description_offsets,
+        "descriptions": descriptions,
+        "genre_name_offsets": genre_name_offsets,
+        "genre_names": genre_name_heap,
+        "author_name_offsets": author_name_offsets,
+        "author_names": author_name_heap,
+        "genre_offsets": genre_offsets,
+        "books_by_genre": books_by_genre,
+        "author_book_offsets": author_book_offsets,
+        "books_by_author": books_by_author,
+        "token_name_offsets": token_name_offsets,
+        "token_names": token_name_heap,
+        "token_offsets": token_offsets,
+        "books_by_token": books_by_token,
+    }
+
+    # Смещения секций зависят от длины заголовка, поэтому место под заголовок считается с запасом:
+    # заголовок дополняется пробелами до размера, рассчитанного при наибольших возможных смещениях
+    def header_for(start):
+        layout = {}
+        offset = start
+        for name, data in sections.items():
+            offset += -offset % ALIGNMENT
+            typecode = data.typecode if isinstance(data, array) else "B"
+            size = len(data) * (data.itemsize if isinstance(data, array) else 1)
+            layout[name] = [offset, size, typecode]
+            offset += size
+        return json.dumps({"version": FORMAT_VERSION, "byteorder": sys.byteorder,
+                           "books": len(books), "source": source, "sections": layout}).encode()
+
+    header_size = len(header_for(1 << 62)) + ALIGNMENT
+    header = header_for(len(MAGIC) + 4 + header_size).ljust(header_size)
+
+    with open(filename, "wb") as file:
+        file.write(MAGIC + header_size.to_bytes(4, "little") + header)
+        for name, data in sections.items():
+            file.write(b"\0" * (-file.tell() % ALIGNMENT))
+            file.write(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Компиляция каталога книг из JSON в двоичный формат")
+    parser.add_argument("source", nargs="?", default="books.json", help="исходный JSON-файл")
+    parser.add_argument("target", nargs="?", default="books.catalogue", help="файл каталога")
+    arguments = parser.parse_args()
+
+    with open(arguments.source, "r", encoding="utf-8") as source:
+        books = json.load(source)
+    compile_catalogue(books, arguments.target, source_fingerprint(arguments.source))
+    print(f"Каталог {arguments.target}: {len(books)} книг")
@@ -0,0 +1,133 @@
+import argparse
+import json
+import os
+from array import array
+from collections import Counter
+from functools import cached_property
+
+import numpy as np
+
+from catalogue import TOKEN_PATTERN, Catalogue, source_fingerprint
+
+# Ранжирование по сходству текста: векторы TF-IDF названия и описания каждой книги.
+# Вес слова в книге — (1 + log tf) * idf, idf = log((1 + n) / (1 + df)) + 1, векторы нормированы.
+# Векторы строятся заранее (python tfidf.py books.json) и хранятся в каталоге books.tfidf как массивы .npy
+# по словам: книги со словом t — doc_ids[term_offsets[t]:term_offsets[t + 1]] с весами weights[...].
+# Массивы открываются через mmap, поэтому запуск не зависит от размера каталога
+VECTORS_DIRECTORY = "books.tfidf"
+
+
+def book_terms(title, description):
+    return TOKEN_PATTERN.findall(f"{title}\n{description}".lower())
+
+
+# Строит векторы для книг (список из books.json или скомпилированный каталог) и сохраняет их в directory;
+# source — отпечаток исходных данных (source_fingerprint), по нему open_vectors узнаёт, для каких книг собраны векторы
+def build_vectors(books, source, directory=VECTORS_DIRECTORY):
+    if isinstance(books, Catalogue):
+        texts = zip(books.titles, books.descriptions)
+    else:
+        texts = ((book.get("title", ""), book["description"]) for book in books)
+
+    vocabulary = {}
+    doc_offsets = array("q", [0])
+    doc_terms = array("I")
+    doc_counts = array("I")
+    for title, description in texts:
+        for term, count in Counter(book_terms(title, description)).items():
+            doc_terms.append(vocabulary.setdefault(term, len(vocabulary)))
+            doc_counts.append(count)
+        doc_offsets.append(len(doc_terms))
+
+    books_count = len(doc_offsets) - 1
+    terms = np.frombuffer(doc_terms, dtype=np.uint32)
+    document_frequency = np.bincount(terms, minlength=len(vocabulary))
+    idf = np.log((1 + books_count) / (1 + document_frequency)) + 1
+    weights = (1 + np.log(np.frombuffer(doc_counts, dtype=np.uint32))) * idf[terms]
+
+    # Нормировка векторов книг; книги без слов остаются нулевыми
+    doc_ids = np.repeat(np.arange(books_count, dtype=np.uint32), np.diff(np.frombuffer(doc_offsets, dtype=np.int64)))
+    norms = np.sqrt(np.bincount(doc_ids, weights=weights ** 2, minlength=books_count))
+    weights /= norms[doc_ids]
+
+    # Порядок по словам; устойчивая сортировка оставляет книги каждого слова по возрастанию номера
+    order = np.argsort(terms, kind="stable")
+    term_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    np.cumsum(document_frequency, out=term_offsets[1:])
+
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, "term_offsets.npy"), term_offsets)
+    np.save(os.path.join(directory, "doc_ids.npy"), doc_ids[order])
+    np.save(os.path.join(directory, "weights.npy"), weights[order].astype(np.float32))
+    with open(os.path.join(directory, "vocabulary.json"), "w", encoding="utf-8") as file:
+        json.dump(list(vocabulary), file, ensure_ascii=False)
+    # meta.json пишется последним: по нему векторы считаются собранными
+    with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as file:
+        json.dump({"books": books_count, "terms": len(vocabulary), "source": source}, file)
+
+
+# Векторы, собранные build_vectors
+class TfidfVectors:
+    def __init__(self, directory=VECTORS_DIRECTORY):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as file:
+            meta = json.load(file)
+        self.books_count = meta["books"]
+        self.source = meta.get("source")
+        self.term_offsets = np.load(os.path.join(directory, "term_offsets.npy"), mmap_mode="r")
+        self.doc_ids = np.load(os.path.join(directory, "doc_ids.npy"), mmap_mode="r")
+        self.weights = np.load(os.path.join(directory, "weights.npy"), mmap_mode="r")
+
+    # Словарь читается при первом запросе: {слово: номер}
+    @cached_property
+    def vocabulary(self):
+        with open(os.path.join(self.directory, "vocabulary.json"), encoding="utf-8") as file:
+            return {term: term_id for term_id, term in enumerate(json.load(file))}
+
+    # Сходство книг с запросом: {номер книги: косинус векторов в (0, 1]} для книг хотя бы с одним словом запроса.
+    # Вектор запроса — idf его слов; произведение матрицы книг на него считается одним np.bincount по спискам книг этих слов
+    def similarities(self, keywords):
+        query = Counter(term for keyword in keywords for term in TOKEN_PATTERN.findall(keyword.lower()))
+        terms = [term for term in query if term in self.vocabulary]
+        if not terms:
+            return {}
+
+        term_ids = np.array([self.vocabulary[term] for term in terms])
+        starts = self.term_offsets[term_ids]
+        ends = self.term_offsets[term_ids + 1]
+        idf = np.log((1 + self.books_count) / (1 + (ends - starts))) + 1
+        query_weights = (1 + np.log([query[term] for term in terms])) * idf
+        query_weights /= np.linalg.norm(query_weights)
+
+        doc_ids = np.concatenate([self.doc_ids[start:end] for start, end in zip(starts, ends)])
+        weights = np.concatenate([self.weights[start:end] * query_weight
+                                  for start, end, query_weight in zip(starts, ends, query_weights)])
+        scores = np.bincount(doc_ids, weights=weights, minlength=self.books_count)
+        matched = np.flatnonzero(scores)
+        return dict(zip(matched.tolist(), scores[matched].tolist()))
+
+
+# Векторы из directory, если они собраны из тех же данных, что и source_filename (books.json или каталог,
+# скомпилированный из него), для books_count книг; иначе None
+def open_vectors(books_count, source_filename, directory=VECTORS_DIRECTORY):
+    if not os.path.exists(os.path.join(directory, "meta.json")):
+        return None
+    vectors = TfidfVectors(directory)
+    if vectors.books_count != books_count or vectors.source != source_fingerprint(source_filename):
+        return None
+    return vectors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Построение векторов TF-IDF для ранжирования книг")
+    parser.add_argument("source", nargs="?", default="books.json", help="books.json или скомпилированный каталог")
+    parser.add_argument("directory", nargs="?", default=VECTORS_DIRECTORY, help="каталог для векторов")
+    arguments = parser.parse_args()
+
+    if arguments.source.endswith(".json"):
+        with open(arguments.source, "r", encoding="utf-8") as source:
+            books = json.load(source)
+    else:
+        books = Catalogue(arguments.source)
+    build_vectors(books, source_fingerprint(arguments.source), arguments.directory)
+    print(f"Векторы {arguments.directory}: {len(books)} книг")